@@ -0,0 +1,150 @@
+# bench_startup.py
+# Замер холодного старта. Каждый прогон — новый процесс, как после пробуждения
+# сервиса на Render:
+#   * импорт: `python -X importtime -c "import main"` — общее время процесса,
+#     время импорта main.py и самые тяжёлые пакеты, которые он тянет;
+#   * --serve: запуск uvicorn main:app и время до первого ответа /health и
+#     /ready плюс фазы из STARTUP_PHASES (импорты, инициализация, отложенный старт).
+#
+# Для замера импорта BOT_TOKEN, DATABASE_URL и WEBHOOK_BASE_URL не нужны: main.py
+# проверяет их при импорте, поэтому незаданные подменяются заглушками.
+# --serve поднимает настоящего бота: пул к DATABASE_URL, выборы лидера, команды
+# и вебхук на WEBHOOK_BASE_URL. Запускайте его только с тестовыми BOT_TOKEN и БД.
+#
+#   python bench_startup.py --runs 5
+#   python bench_startup.py --serve --runs 3 --json
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# ---------- импорт ----------
+def import_profile(python: str, env: dict) -> dict:
+    t0 = time.perf_counter()
+    proc = subprocess.run([python, "-X", "importtime", "-c", "import main"],
+                          cwd=HERE, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if proc.returncode:
+        raise RuntimeError(proc.stderr[-2000:])
+    # строки идут в post-order: прямые импорты main (глубина 1) печатаются перед самим main
+    total, packages, children = 0.0, {}, {}
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        cumulative = int(parts[1]) / 1e6
+        field = parts[2][1:]
+        depth = (len(field) - len(field.lstrip())) // 2
+        name = field.strip()
+        if depth == 0:
+            if name == "main":
+                total, packages = cumulative, children
+            children = {}
+        elif depth == 1:
+            top = name.split(".")[0]
+            children[top] = children.get(top, 0.0) + cumulative
+    return {"process": wall, "import_main": total, "packages": packages}
+
+# ---------- запуск сервера ----------
+def _get(url: str) -> tuple[int | None, bytes]:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as r:
+            return r.status, r.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except (urllib.error.URLError, OSError):
+        return None, b""
+
+def serve_once(python: str, env: dict, port: int, timeout: float) -> dict:
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([python, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    result: dict = {"health": None, "ready": None, "phases": {}}
+    try:
+        while time.perf_counter() - t0 < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(proc.stderr.read()[-2000:])
+            if result["health"] is None and _get(base + "/health")[0] == 200:
+                result["health"] = time.perf_counter() - t0
+            status, body = _get(base + "/ready")
+            if status == 200:
+                if result["ready"] is None:
+                    result["ready"] = time.perf_counter() - t0
+                data = json.loads(body)
+                result["phases"] = data["phases"]
+                if data["deferred_done"]:
+                    break
+            time.sleep(0.01)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+    return result
+
+# ---------- отчёт ----------
+def _median(values) -> float | None:
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+def _fmt(value: float | None) -> str:
+    return "—" if value is None else f"{value:.3f}s"
+
+def main(argv: list[str] | None = None) -> int:
+    p = argparse.ArgumentParser(description="Measure main.py cold start: imports, init and deferred startup.")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--top", type=int, default=8, help="how many imported packages to list")
+    p.add_argument("--serve", action="store_true", help="also start uvicorn and time /health and /ready")
+    p.add_argument("--port", type=int, default=18080)
+    p.add_argument("--timeout", type=float, default=60)
+    p.add_argument("--json", action="store_true", help="print results as JSON")
+    args = p.parse_args(argv)
+
+    env = dict(os.environ)
+    env.setdefault("WEBHOOK_BASE_URL", "https://bench.invalid")  # main.py требует его при импорте
+    import_env = dict(env)  # импорт не ходит ни в Telegram, ни в БД
+    import_env.setdefault("BOT_TOKEN", "123456:bench")
+    import_env.setdefault("DATABASE_URL", "postgresql://bench.invalid/bench")
+
+    imports = [import_profile(sys.executable, import_env) for _ in range(args.runs)]
+    report: dict = {
+        "runs": args.runs,
+        "process": _median(r["process"] for r in imports),
+        "import_main": _median(r["import_main"] for r in imports),
+        "packages": dict(sorted(
+            ((name, _median(r["packages"].get(name) for r in imports)) for name in imports[0]["packages"]),
+            key=lambda kv: -kv[1]
+        )[:args.top]),
+    }
+    if args.serve:
+        serves = [serve_once(sys.executable, env, args.port, args.timeout) for _ in range(args.runs)]
+        report["health"] = _median(r["health"] for r in serves)
+        report["ready"] = _median(r["ready"] for r in serves)
+        names = list(dict.fromkeys(k for r in serves for k in r["phases"]))
+        report["phases"] = {k: _median(r["phases"].get(k) for r in serves) for k in names}
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return 0
+    print(f"python -c 'import main': process {_fmt(report['process'])}, import main {_fmt(report['import_main'])}"
+          f" (median of {args.runs})")
+    for name, seconds in report["packages"].items():
+        print(f"  {name:<28} {_fmt(seconds)}")
+    if args.serve:
+        print(f"uvicorn main:app: /health {_fmt(report['health'])}, /ready {_fmt(report['ready'])}")
+        for name, seconds in report["phases"].items():
+            print(f"  {name:<28} {_fmt(seconds)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
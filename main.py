@@ -1,30 +1,64 @@
 # main.py
+import time
+_BOOT_T0 = time.perf_counter()  # отсчёт фаз холодного старта, см. STARTUP_PHASES
+
 import asyncio
+import calendar as _calendar
+import heapq
+import hmac
+import html
 import logging
 import os
+import random
+import re
 import json
 import signal
-from contextlib import asynccontextmanager
+import sys
+import threading
+import zlib
+from collections import Counter, OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, date as _date, time as _time, UTC, timedelta
 
+# Фазы холодного старта (секунды): импорты, инициализация, отложенные задачи.
+# Отдаются в /ready и печатаются в лог; внешний замер — bench_startup.py.
+STARTUP_PHASES: dict[str, float] = {}
+_phase_t = _BOOT_T0
+
+def startup_phase(name: str):
+    global _phase_t
+    now = time.perf_counter()
+    STARTUP_PHASES[name] = round(now - _phase_t, 4)
+    _phase_t = now
+
+startup_phase("import:stdlib")
+
 import asyncpg
 from dotenv import load_dotenv
+startup_phase("import:asyncpg")
 
-from aiogram import Bot, Dispatcher, F, Router
-from aiogram.exceptions import TelegramBadRequest
-from aiogram.filters import CommandStart, Command, StateFilter
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.dispatcher.flags import get_flag
+from aiogram.filters import CommandStart, Command, StateFilter, ExceptionTypeFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.types import (
     Message, ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
     BotCommand, BotCommandScopeDefault, BotCommandScopeChat,
-    ChatMemberUpdated, Update
+    ChatMemberUpdated, Update, User, BufferedInputFile, ErrorEvent,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent
 )
 from aiogram.utils.markdown import hbold
+startup_phase("import:aiogram")
 
 # ============================= WEBHOOK + FastAPI =============================
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
+startup_phase("import:fastapi")
 
 app = FastAPI()  # <-- это ВАЖНО
 
@@ -36,6 +70,7 @@ WEBHOOK_SECRET_PATH = os.getenv("WEBHOOK_SECRET_PATH", "hook")
 WEBHOOK_PATH        = f"/webhook/{WEBHOOK_SECRET_PATH}"
 WEBHOOK_URL         = f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}"
 PORT                = int(os.getenv("PORT", "10000"))
+ALLOWED_UPDATES     = ["message", "callback_query", "my_chat_member", "inline_query"]
 
 # ---------- ВАЖНО: ГЛОБАЛЬНЫЙ ASGI app ----------
 app = FastAPI()
@@ -50,25 +85,236 @@ dp: Dispatcher | None = None
 async def health():
     return "ok"
 
-# ============================= SIGTERM лог =============================
-def _on_term(*_):
-    logger.warning("Got SIGTERM from platform. Graceful shutdown (redeploy/scale/change).")
-signal.signal(signal.SIGTERM, _on_term)
+# /health — процесс жив; /ready — можно слать апдейты: пул и диспетчер готовы, схема
+# БД текущей версии, не дренируемся. Отложенная часть старта (лидер, команды,
+# вебхук) на готовность не влияет, а схема — влияет: без таблиц хендлеры падают.
+READY = False
+DEFERRED_STARTUP_DONE = False
+
+@app.get("/ready")
+async def ready():
+    body = {
+        "ready": READY and not DRAINING,
+        "deferred_done": DEFERRED_STARTUP_DONE,
+        "leader": IS_LEADER,
+        "db": {"state": POOL_HEALTH.state, "lost_recently": POOL_HEALTH.lost_recently},
+        "phases": STARTUP_PHASES,
+    }
+    return Response(json.dumps(body), status_code=200 if body["ready"] else 503, media_type="application/json")
+
+# ============================= Graceful drain =============================
+# На SIGTERM (редеплой/скейл) перестаём принимать апдейты: отвечаем 503, и Telegram
+# повторит доставку — её подхватит новый инстанс. Вебхук при этом остаётся
+# зарегистрированным. Начатые хендлеры и фоновые задачи дорабатывают до дедлайна.
+#
+# Бюджет остановки: после SIGTERM платформа ждёт SHUTDOWN_GRACE_S (Render:
+# maxShutdownDelaySeconds в render.yaml) и убивает процесс. Дедлайн drain общий
+# для ожидания апдейтов до остановки сервера и фоновых задач в shutdown-хуке;
+# между ними uvicorn ещё до SERVER_GRACEFUL_S ждёт открытые соединения. Итого
+# не больше DRAIN_TIMEOUT_S + SERVER_GRACEFUL_S, и DRAIN_MARGIN_S остаётся на
+# закрытие пулов и сессии бота.
+SHUTDOWN_GRACE_S  = float(os.getenv("SHUTDOWN_GRACE_S", "30"))
+SERVER_GRACEFUL_S = 5  # = --timeout-graceful-shutdown в render.yaml
+DRAIN_MARGIN_S    = 3
+DRAIN_TIMEOUT_S   = float(os.getenv("DRAIN_TIMEOUT_S", SHUTDOWN_GRACE_S - SERVER_GRACEFUL_S - DRAIN_MARGIN_S))
+
+DRAINING = False
+_drain_started: float | None = None
+_inflight = 0
+_idle = asyncio.Event()
+_idle.set()
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    # фоновые задачи держим в множестве: их ждёт drain, и GC не соберёт их раньше времени
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+def begin_drain(reason: str):
+    global DRAINING, _drain_started
+    if DRAINING:
+        return
+    DRAINING, _drain_started = True, time.monotonic()
+    logger.warning("Drain started (%s): in-flight=%s, background=%s", reason, _inflight, len(BACKGROUND_TASKS))
+
+def install_drain_handler():
+    # uvicorn/gunicorn ставят свой обработчик SIGTERM — не заменяем его, а дополняем.
+    # Их обработчик сразу закрывает сокет, и shutdown-хук срабатывает уже после
+    # этого. Поэтому сначала дренируемся при живом сервере (вебхук отвечает 503,
+    # начатые апдейты дорабатывают) и только потом передаём сигнал серверу.
+    prev = signal.getsignal(signal.SIGTERM)
+    loop = asyncio.get_running_loop()
+
+    def _on_term(signum, frame):
+        if DRAINING:  # повторный SIGTERM — останавливаемся, не дожидаясь апдейтов
+            if callable(prev):
+                prev(signum, frame)
+            return
+        begin_drain("SIGTERM from platform (redeploy/scale/change)")
+        if callable(prev):
+            loop.call_soon_threadsafe(_start_server_stop, lambda: prev(signum, frame))
+
+    try:
+        signal.signal(signal.SIGTERM, _on_term)
+    except ValueError:  # не главный поток
+        logger.warning("Cannot install SIGTERM drain handler outside the main thread")
+
+_server_stop: asyncio.Task | None = None
+
+def _start_server_stop(stop):
+    global _server_stop
+    _server_stop = asyncio.get_running_loop().create_task(stop_server_when_idle(stop))
+
+async def stop_server_when_idle(stop):
+    try:
+        await asyncio.wait_for(_idle.wait(), timeout=max(_drain_started + DRAIN_TIMEOUT_S - time.monotonic(), 0))
+    except asyncio.TimeoutError:
+        logger.error("Drain deadline hit with %s in-flight updates, stopping the server anyway", _inflight)
+    else:
+        logger.warning("In-flight updates drained in %.2fs, stopping the server", time.monotonic() - _drain_started)
+    stop()
+
+async def drain():
+    begin_drain("shutdown")
+    deadline = _drain_started + DRAIN_TIMEOUT_S
+    try:
+        await asyncio.wait_for(_idle.wait(), timeout=max(deadline - time.monotonic(), 0))
+    except asyncio.TimeoutError:
+        logger.error("Drain deadline hit with %s in-flight updates", _inflight)
+    cancelled = 0
+    if BACKGROUND_TASKS:
+        _, pending = await asyncio.wait(set(BACKGROUND_TASKS), timeout=max(deadline - time.monotonic(), 0))
+        for task in pending:
+            task.cancel()
+        cancelled = len(pending)
+    logger.warning("Drain finished in %.2fs (in-flight left=%s, background cancelled=%s)",
+                   time.monotonic() - _drain_started, _inflight, cancelled)
 
 @app.on_event("startup")
 async def on_startup():
-    global bot, dp
+    global bot, dp, BOOKING_WRITER, READY
+    startup_phase("server")  # импорт uvicorn, запуск сервера до startup-хука
+
+    install_drain_handler()
 
     # БД
     await init_db_pool()
+    startup_phase("init:db_pool")
+    schema_ready = await schema_is_current()  # обычно так и есть: DDL не нужен
+    startup_phase("init:schema_check")
 
     # Бот и диспетчер
     from aiogram.client.default import DefaultBotProperties
     bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    dp = Dispatcher()
+    bot.session.middleware(ApiTimingMiddleware())
+    storage = None
+    if FSM_REDIS_URL:
+        from aiogram.fsm.storage.redis import RedisStorage  # нужен пакет redis
+        storage = RedisStorage.from_url(FSM_REDIS_URL)
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(SlowUpdateMiddleware())
     dp.include_router(router)
     dp.include_router(guard)
+    # outer: срабатывает до фильтров и хендлеров, т.е. до любого похода в БД
+    throttle = ThrottleMiddleware()
+    dp.message.outer_middleware(throttle)
+    dp.callback_query.outer_middleware(throttle)
+    dp.inline_query.outer_middleware(throttle)
+    # inner: соединение берётся только если апдейт дошёл до хендлера
+    dp.message.middleware(UnitOfWorkMiddleware())
+    dp.callback_query.middleware(UnitOfWorkMiddleware())
+    dp.inline_query.middleware(UnitOfWorkMiddleware())
+
+    if BOOKING_GROUP_COMMIT_MS > 0:
+        BOOKING_WRITER = BookingWriter(BOOKING_GROUP_COMMIT_MS, BOOKING_GROUP_MAX)
+        BOOKING_WRITER.start()
+
+    if PROFILE_ON_START_S > 0:
+        spawn(run_profile(bot, ADMIN_CHAT_ID or None, PROFILE_ON_START_S))
+    startup_phase("init:dispatcher")
+
+    # Всё остальное — после того, как сервер начал отвечать: первый апдейт
+    # после пробуждения не ждёт выборов лидера и вызовов Bot API. Если схема
+    # устарела или её нет, /ready отвечает 503, пока deferred_startup её не применит
+    READY = schema_ready
+    logger.info("Serving after %.2fs%s: %s", time.perf_counter() - _BOOT_T0,
+                "" if READY else " (not ready until schema is applied)",
+                ", ".join(f"{k} {v:.3f}s" for k, v in STARTUP_PHASES.items()))
+    spawn(deferred_startup(bot))
+
+async def deferred_startup(bot: Bot):
+    global DEFERRED_STARTUP_DONE, READY
+    t0 = time.perf_counter()
+    # Без схемы /ready остаётся false — повторяем с backoff, пока не применится
+    attempt = 0
+    while not READY:
+        if DRAINING:
+            return
+        try:
+            await init_db_schema()
+        except Exception:
+            delay = min(retry_delay(attempt), 30)
+            logger.exception("Schema init failed, retrying in %.1fs", delay)
+            attempt = min(attempt + 1, 10)
+            await asyncio.sleep(delay)
+            continue
+        STARTUP_PHASES["deferred:schema"] = round(time.perf_counter() - t0, 4)
+        READY = True
+        logger.info("Schema %s applied, ready after %.2fs", SCHEMA_VERSION, time.perf_counter() - _BOOT_T0)
+    try:
+        await init_replica_pool()
+        # канал уже записан в SESSION_LISTENERS — при переподключении LOCK_CONN подпишемся заново
+        await listen("bookings_changed", on_bookings_changed)
+    except Exception:
+        logger.exception("Replica or LISTEN setup failed")
+    # о проблемах с БД пишет только лидер, чтобы воркеры не дублировали друг друга
+    if ADMIN_CHAT_ID:
+        POOL_HEALTH.subscribe(lambda prev, state: IS_LEADER and spawn(notify_pool_health(bot, state)))
+    spawn(watch_leadership(bot))  # и переизбрание, если первая попытка не удалась
+    # Разовые задачи деплоя — только на лидере, фолловеры сразу обслуживают апдейты.
+    # Сбой leader_startup снимает лидерство (start_leading), watch_leadership переизберёт
+    try:
+        if await elect_leader():
+            await start_leading(bot)
+    except Exception:
+        logger.exception("Leader election failed, watch loop will retry")
+    STARTUP_PHASES["deferred"] = round(time.perf_counter() - t0, 4)
+    DEFERRED_STARTUP_DONE = True
+    logger.info("Deferred startup done in %.2fs", STARTUP_PHASES["deferred"])
+
+# NOTIFY от триггера на bookings; payload — дата изменённой брони
+def on_bookings_changed(conn, pid, channel, payload: str):
+    wake_feed()
+    try:
+        invalidate_calendar(_date.fromisoformat(payload))
+    except ValueError:
+        _calendar_cache.clear()
+    if DASHBOARD:
+        DASHBOARD.mark_dirty()
 
+async def leader_startup(bot: Bot):
+    global DASHBOARD
+    spawn_leader(ensure_search_indexes())
+
+    # Живая панель загрузки в админ-чате
+    if ADMIN_CHAT_ID:
+        DASHBOARD = Dashboard(bot, ADMIN_CHAT_ID)
+        spawn_leader(DASHBOARD.run())
+
+    spawn_leader(prune_booking_events())
+
+    # Лист ожидания: освободившиеся столики предлагает только лидер
+    await listen("slot_freed", on_slot_freed, leader_only=True)
+    spawn_leader(expire_waitlist_offers())
+
+    # Рассылки: продолжаем прерванные редеплоем и ждём новые
+    await listen("broadcast", lambda *args: _broadcast_wake.set(), leader_only=True)
+    spawn_leader(run_broadcasts(bot))
+
+    # Вызовы Bot API — последними: они самые медленные из разовых задач
+    t0 = time.perf_counter()
     # Команды
     for uid in STAFF_USER_IDS:
         try:
@@ -76,33 +322,65 @@ async def on_startup():
         except Exception:
             pass
     if ADMIN_CHAT_ID:
-        await set_chat_admin_commands(bot, ADMIN_CHAT_ID, "ru")
+        try:
+            await set_chat_admin_commands(bot, ADMIN_CHAT_ID, "ru")
+        except Exception as e:  # неверный ADMIN_CHAT_ID не должен бесконечно срывать старт лидера
+            logger.warning("Cannot set commands for admin chat %s: %r", ADMIN_CHAT_ID, e)
     await set_default_commands(bot)
 
     # Осторожно регистрируем вебхук на свой Render-URL
     info = await bot.get_webhook_info()
-    if info.url != WEBHOOK_URL:
+    if info.url != WEBHOOK_URL or set(info.allowed_updates or ()) != set(ALLOWED_UPDATES):
         await bot.set_webhook(
             url=WEBHOOK_URL,
-            allowed_updates=["message", "callback_query", "my_chat_member"],
+            allowed_updates=ALLOWED_UPDATES,
             drop_pending_updates=False,  # важно!
         )
+    STARTUP_PHASES["deferred:bot_api"] = round(time.perf_counter() - t0, 4)
+
+async def notify_pool_health(bot: Bot, state: str):
+    text = {
+        "ok": "✅ БД: соединения восстановились",
+        "degraded": f"⚠️ БД: соединения рвутся ({POOL_HEALTH.lost_recently} за минуту)",
+        "down": f"🛑 БД недоступна: {POOL_HEALTH.last_error!r}",
+    }[state]
+    try:
+        await bot.send_message(ADMIN_CHAT_ID, text)
+    except Exception:
+        logger.exception("Cannot report pool health")
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    # вебхук не снимаем: апдейты, пришедшие во время переключения, Telegram
+    # доставит повторно уже новому инстансу
+    await drain()
+    await resign_leader()
     if bot:
-        try:
-            await bot.delete_webhook(drop_pending_updates=False)
-        except Exception:
-            pass
+        await bot.session.close()
+    if POOL:
+        await POOL.close()
+    if REPLICA_POOL:
+        await REPLICA_POOL.close()
 
 # Приём апдейтов от Telegram (должен совпасть с WEBHOOK_PATH)
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
+    global _inflight
+    if DRAINING or not READY:
+        # не-2xx ответ: Telegram повторит доставку позже
+        return Response(status_code=503, headers={"Retry-After": "1"})
     assert bot is not None and dp is not None, "Bot/Dispatcher not ready yet"
-    data = await request.json()
-    update = Update.model_validate(data)
-    await dp.feed_update(bot, update)
+    # считаем апдейт начатым до первого await: иначе drain может решить, что всё
+    # доработано, пока тело запроса ещё читается
+    _inflight += 1
+    _idle.clear()
+    try:
+        update = Update.model_validate(await request.json())
+        await dp.feed_update(bot, update)
+    finally:
+        _inflight -= 1
+        if _inflight == 0:
+            _idle.set()
     return {"ok": True}
 
 # ============================= I18N =============================
@@ -173,7 +451,27 @@ I18N = {
         "done_confirmed": "Подтверждено",
         "done_cancelled": "Отменено",
         "done_deleted": "Удалено",
-        "reply_stub": "Меню"
+        "reply_stub": "Меню",
+        "err_flood": "⏳ Слишком много запросов. Подождите пару секунд.",
+        "err_table_taken": "😕 Этот столик только что заняли. Введите другое время.",
+        "err_busy": "⏳ Сейчас много запросов. Попробуйте ещё раз через несколько секунд.",
+        "ask_date_pick": "🗓 Выберите дату (или введите ДД.ММ.ГГГГ).\n{legend}",
+        "cal_legend": "5 — есть места, 5* — мест мало, × — мест нет",
+        "cal_weekdays": "Пн,Вт,Ср,Чт,Пт,Сб,Вс",
+        "cal_months": "Январь,Февраль,Март,Апрель,Май,Июнь,Июль,Август,Сентябрь,Октябрь,Ноябрь,Декабрь",
+        "date_picked": "🗓 Дата: {date}",
+        "btn_waitlist_join": "🔔 Встать в лист ожидания",
+        "wl_ask_window": "Какое время вам подходит?",
+        "btn_wl_win_30": "±30 мин",
+        "btn_wl_win_60": "±1 час",
+        "btn_wl_win_day": "Весь день",
+        "wl_joined": "🔔 Готово! Если {date} с {time_from} до {time_to} освободится столик на {guests} гост., мы сразу напишем.",
+        "wl_offer": "🎉 Освободился столик: {date} в {time}, гостей: {guests}. Держим его для вас {minutes} мин.",
+        "btn_wl_accept": "✅ Беру",
+        "btn_wl_decline": "✖️ Не нужно",
+        "wl_accepted": "✅ Столик ваш! Ждём вас {date} в {time}.",
+        "wl_declined": "Хорошо, предложим столик другим гостям.",
+        "wl_expired": "⌛ Время на ответ истекло, столик предложен другим гостям."
     },
     "lv": {
         "start": "👋 Sveiki! Es esmu galdu rezervēšanas bots.\n\nNospiediet «{btn_book}» un atbildiet uz jautājumiem — tas ir ātri.",
@@ -239,7 +537,27 @@ I18N = {
         "done_confirmed": "Apstiprināts",
         "done_cancelled": "Atcelts",
         "done_deleted": "Dzēsts",
-        "reply_stub": "Izvēlne"
+        "reply_stub": "Izvēlne",
+        "err_flood": "⏳ Pārāk daudz pieprasījumu. Uzgaidiet pāris sekundes.",
+        "err_table_taken": "😕 Šis galds tikko tika aizņemts. Ievadiet citu laiku.",
+        "err_busy": "⏳ Šobrīd ir daudz pieprasījumu. Mēģiniet vēlreiz pēc dažām sekundēm.",
+        "ask_date_pick": "🗓 Izvēlieties datumu (vai ievadiet DD.MM.GGGG).\n{legend}",
+        "cal_legend": "5 — ir vietas, 5* — maz vietu, × — vietu nav",
+        "cal_weekdays": "P,O,T,C,Pk,S,Sv",
+        "cal_months": "Janvāris,Februāris,Marts,Aprīlis,Maijs,Jūnijs,Jūlijs,Augusts,Septembris,Oktobris,Novembris,Decembris",
+        "date_picked": "🗓 Datums: {date}",
+        "btn_waitlist_join": "🔔 Pieteikties gaidīšanas sarakstā",
+        "wl_ask_window": "Kāds laiks jums der?",
+        "btn_wl_win_30": "±30 min",
+        "btn_wl_win_60": "±1 st.",
+        "btn_wl_win_day": "Visa diena",
+        "wl_joined": "🔔 Gatavs! Ja {date} no {time_from} līdz {time_to} atbrīvosies galds {guests} viesiem, mēs uzreiz uzrakstīsim.",
+        "wl_offer": "🎉 Atbrīvojās galds: {date} plkst. {time}, viesi: {guests}. Turam to jums {minutes} min.",
+        "btn_wl_accept": "✅ Ņemu",
+        "btn_wl_decline": "✖️ Nevajag",
+        "wl_accepted": "✅ Galds ir jūsu! Gaidām jūs {date} plkst. {time}.",
+        "wl_declined": "Labi, piedāvāsim galdu citiem viesiem.",
+        "wl_expired": "⌛ Atbildes laiks beidzās, galds piedāvāts citiem viesiem."
     },
     "en": {
         "start": "👋 Hi! I'm a table booking bot.\n\nTap “{btn_book}” and answer a few questions — it's quick.",
@@ -305,7 +623,27 @@ I18N = {
         "done_confirmed": "Confirmed",
         "done_cancelled": "Cancelled",
         "done_deleted": "Deleted",
-        "reply_stub": "Menu"
+        "reply_stub": "Menu",
+        "err_flood": "⏳ Too many requests. Please wait a few seconds.",
+        "err_table_taken": "😕 This table was just taken. Please enter another time.",
+        "err_busy": "⏳ We're busy right now. Please try again in a few seconds.",
+        "ask_date_pick": "🗓 Pick a date (or type DD.MM.YYYY).\n{legend}",
+        "cal_legend": "5 — available, 5* — few left, × — full",
+        "cal_weekdays": "Mo,Tu,We,Th,Fr,Sa,Su",
+        "cal_months": "January,February,March,April,May,June,July,August,September,October,November,December",
+        "date_picked": "🗓 Date: {date}",
+        "btn_waitlist_join": "🔔 Join the waitlist",
+        "wl_ask_window": "Which times work for you?",
+        "btn_wl_win_30": "±30 min",
+        "btn_wl_win_60": "±1 hour",
+        "btn_wl_win_day": "Any time that day",
+        "wl_joined": "🔔 Done! If a table for {guests} frees up on {date} between {time_from} and {time_to}, we'll message you right away.",
+        "wl_offer": "🎉 A table is free: {date} at {time} for {guests}. We're holding it for you for {minutes} min.",
+        "btn_wl_accept": "✅ Book it",
+        "btn_wl_decline": "✖️ No thanks",
+        "wl_accepted": "✅ The table is yours! See you on {date} at {time}.",
+        "wl_declined": "Okay, we'll offer the table to other guests.",
+        "wl_expired": "⌛ The hold has expired and the table was offered to other guests."
     },
 }
 
@@ -346,6 +684,7 @@ ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 MENU_URL      = os.getenv("MENU_URL", "")
 DATABASE_URL  = os.getenv("DATABASE_URL", "")
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "")  # общее FSM-хранилище для нескольких воркеров
 
 STAFF_USER_IDS: set[int] = _parse_ids(os.getenv("STAFF_USER_IDS", ""))
 if ADMIN_USER_ID:
@@ -377,9 +716,18 @@ PUBLIC_COMMANDS = {
            BotCommand(command="book",  description="Reserve a table")],
 }
 ADMIN_COMMANDS = {
-    "ru": [BotCommand(command="admin", description="Админ-панель")],
-    "lv": [BotCommand(command="admin", description="Admin panelis")],
-    "en": [BotCommand(command="admin", description="Admin panel")],
+    "ru": [BotCommand(command="admin", description="Админ-панель"),
+           BotCommand(command="find", description="Поиск брони: телефон, имя, ID"),
+           BotCommand(command="profile", description="Профилирование (сек)"),
+           BotCommand(command="broadcast", description="Рассылка всем гостям")],
+    "lv": [BotCommand(command="admin", description="Admin panelis"),
+           BotCommand(command="find", description="Meklēt: tālrunis, vārds, ID"),
+           BotCommand(command="profile", description="Profilēšana (sek)"),
+           BotCommand(command="broadcast", description="Ziņojums visiem viesiem")],
+    "en": [BotCommand(command="admin", description="Admin panel"),
+           BotCommand(command="find", description="Find booking: phone, name, ID"),
+           BotCommand(command="profile", description="Profile the bot (sec)"),
+           BotCommand(command="broadcast", description="Message all guests")],
 }
 
 async def set_default_commands(bot: Bot):
@@ -424,43 +772,814 @@ CREATE TABLE IF NOT EXISTS bookings (
     created_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 """
+CREATE_BROADCASTS = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id SERIAL PRIMARY KEY,
+    texts JSONB NOT NULL,  -- {"ru": ..., "lv": ..., "en": ...}
+    status TEXT NOT NULL DEFAULT 'draft',  -- draft / running / done / cancelled
+    created_by BIGINT NOT NULL,
+    chat_id BIGINT NOT NULL,  -- куда слать отчёт
+    report_message_id BIGINT,
+    total INT NOT NULL DEFAULT 0,
+    last_user_id BIGINT NOT NULL DEFAULT 0,  -- курсор по users.user_id
+    sent INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    blocked INT NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ
+);
+"""
+CREATE_BOT_STATE = """
+CREATE TABLE IF NOT EXISTS bot_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+# Журнал изменений броней для внешних систем (см. «Лента изменений»). txid —
+# номер транзакции записи: курсор идёт по (txid, id), а не по id, потому что id
+# из sequence коммитятся не по порядку. BRIN по created_at — для чистки по сроку.
+CREATE_BOOKING_EVENTS = """
+CREATE TABLE IF NOT EXISTS booking_events (
+    id BIGSERIAL PRIMARY KEY,
+    txid BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+    booking_id INT NOT NULL,
+    kind TEXT NOT NULL,
+    booking JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS booking_events_cursor_idx ON booking_events (txid, id);
+CREATE INDEX IF NOT EXISTS booking_events_created_brin ON booking_events USING brin (created_at);
+"""
+# Лист ожидания. Подбор гостя на освободившийся столик идёт по GiST-индексу окна
+# (дата + время начала/конца как tsrange): из листа на дату читаются только окна,
+# пересекающие свободный промежуток, и среди них выбирается лучший кандидат.
+CREATE_WAITLIST = """
+CREATE TABLE IF NOT EXISTS waitlist (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    lang TEXT NOT NULL,
+    name TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    booking_date DATE NOT NULL,
+    pref_time TIME NOT NULL,
+    time_from TIME NOT NULL,
+    time_to TIME NOT NULL,
+    guests INT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'waiting',  -- waiting / offered / booked / declined / expired
+    booking_id INT,
+    hold_until TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS waitlist_match_idx
+    ON waitlist (booking_date, guests DESC, time_from, id) WHERE status = 'waiting';
+CREATE INDEX IF NOT EXISTS waitlist_window_idx
+    ON waitlist USING gist (tsrange(booking_date + time_from, booking_date + time_to, '[]'))
+    WHERE status = 'waiting';
+CREATE INDEX IF NOT EXISTS waitlist_hold_idx ON waitlist (hold_until) WHERE status = 'offered';
+"""
+# Бронь перестала занимать столик (отмена или удаление) — NOTIFY slot_freed для листа ожидания
+CREATE_SLOT_FREED_NOTIFY = """
+CREATE OR REPLACE FUNCTION notify_slot_freed() RETURNS trigger AS $$
+BEGIN
+    IF OLD.table_id IS NOT NULL AND OLD.status IN ('new','confirmed','held')
+       AND (TG_OP = 'DELETE' OR NEW.status NOT IN ('new','confirmed','held')) THEN
+        PERFORM pg_notify('slot_freed', json_build_object(
+            'date', OLD.booking_date, 'time', OLD.booking_time, 'table_id', OLD.table_id)::text);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS slot_freed ON bookings;
+CREATE TRIGGER slot_freed AFTER UPDATE OF status OR DELETE ON bookings
+    FOR EACH ROW EXECUTE FUNCTION notify_slot_freed();
+"""
+# Индексы поиска для /find: префикс имени и суффикс телефона (только цифры,
+# развёрнутые — суффикс становится префиксом). text_pattern_ops даёт поиск по
+# диапазону ~>=~ / ~<~, который работает и в generic-плане prepared statement.
+# Строятся фоном на лидере (см. ensure_search_indexes), а не в схеме при старте.
+CREATE_SEARCH_INDEXES = {
+    "bookings_name_prefix_idx":
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS bookings_name_prefix_idx "
+        "ON bookings (lower(name) text_pattern_ops)",
+    "bookings_phone_suffix_idx":
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS bookings_phone_suffix_idx "
+        "ON bookings (reverse(regexp_replace(phone, '\\D', '', 'g')) text_pattern_ops)",
+}
+# Любое изменение bookings шлёт NOTIFY с датой брони — без лишних запросов из
+# хендлеров. Одинаковые уведомления в одной транзакции Postgres схлопывает.
+CREATE_BOOKINGS_NOTIFY = """
+CREATE OR REPLACE FUNCTION notify_bookings_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('bookings_changed', COALESCE(NEW.booking_date, OLD.booking_date)::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS bookings_changed ON bookings;
+CREATE TRIGGER bookings_changed AFTER INSERT OR UPDATE OR DELETE ON bookings
+    FOR EACH ROW EXECUTE FUNCTION notify_bookings_changed();
+"""
 
 async def init_db_pool():
     global POOL
-    POOL = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+    POOL = await asyncpg.create_pool(
+        DATABASE_URL, min_size=1, max_size=DB_POOL_MAX, init=_init_conn, **pool_options()
+    )
+    logger.info("Postgres pool ready%s", f" ({DB_POOLER} pooler mode)" if DB_POOLER else "")
+
+async def init_replica_pool():
+    global REPLICA_POOL
+    if DATABASE_REPLICA_URL:
+        try:
+            REPLICA_POOL = await asyncpg.create_pool(
+                DATABASE_REPLICA_URL, min_size=1, max_size=REPLICA_POOL_MAX, init=_init_replica_conn,
+                **pool_options()
+            )
+        except REPLICA_ERRORS as e:  # без реплики работаем, просто всё читаем с primary
+            logger.warning("Read replica pool failed to start: %r", e)
+        else:
+            spawn(track_replica_lag())
+            logger.info("Replica pool ready")
+
+# DDL по порядку
+SCHEMA_DDL = (
+    CREATE_TABLES,
+    CREATE_USERS,
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ;",
+    CREATE_BOOKINGS,
+    "ALTER TABLE bookings ADD COLUMN IF NOT EXISTS duration_min INT NOT NULL DEFAULT 120;",
+    CREATE_BOT_STATE,
+    CREATE_BROADCASTS,
+    CREATE_BOOKING_EVENTS,
+    CREATE_WAITLIST,
+    CREATE_SLOT_FREED_NOTIFY,
+    CREATE_BOOKINGS_NOTIFY,
+)
+# Версия схемы — хеш DDL: если в bot_state она та же, DDL при старте не гоняем
+SCHEMA_VERSION = f"{zlib.crc32(''.join(SCHEMA_DDL).encode()):08x}"
+SCHEMA_LOCK_NS = 0x0B0E  # advisory lock: DDL применяет один воркер, остальные ждут
+
+async def fetch_schema_version(conn: asyncpg.Connection) -> str | None:
+    # без исключения UndefinedTable: внутри транзакции оно бы её оборвало
+    if await conn.fetchval("SELECT to_regclass('bot_state')") is None:
+        return None
+    return await conn.fetchval("SELECT value FROM bot_state WHERE key='schema_version'")
+
+async def schema_is_current() -> bool:
+    async with POOL.acquire() as conn:
+        return await fetch_schema_version(conn) == SCHEMA_VERSION
+
+# Весь DDL транзакционный, поэтому применяется одной транзакцией под xact-lock —
+# это работает и через пулер в transaction mode
+async def init_db_schema():
     async with POOL.acquire() as conn:
-        await conn.execute(CREATE_TABLES)
-        await conn.execute(CREATE_USERS)
-        await conn.execute(CREATE_BOOKINGS)
-        await conn.execute("ALTER TABLE bookings ADD COLUMN IF NOT EXISTS duration_min INT NOT NULL DEFAULT 120;")
-        cnt = await conn.fetchval("SELECT COUNT(*) FROM tables;")
-        if cnt == 0:
-            await conn.executemany(
-                "INSERT INTO tables(title, seats) VALUES($1, $2)",
-                [("Зал №1", 4), ("Терраса", 2), ("VIP", 6)]
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1::int, 0)", SCHEMA_LOCK_NS)
+            if await fetch_schema_version(conn) == SCHEMA_VERSION:
+                logger.info("Postgres schema %s is up to date", SCHEMA_VERSION)
+                return
+            for ddl in SCHEMA_DDL:
+                await conn.execute(ddl)
+            cnt = await conn.fetchval("SELECT COUNT(*) FROM tables;")
+            if cnt == 0:
+                await conn.executemany(
+                    "INSERT INTO tables(title, seats) VALUES($1, $2)",
+                    [("Зал №1", 4), ("Терраса", 2), ("VIP", 6)]
+                )
+            await conn.execute(
+                "INSERT INTO bot_state(key, value) VALUES('schema_version', $1) "
+                "ON CONFLICT (key) DO UPDATE SET value=$1",
+                SCHEMA_VERSION
             )
-    logger.info("Postgres pool ready")
+    logger.info("Postgres schema %s ready", SCHEMA_VERSION)
+
+# CONCURRENTLY не блокирует запись, но на большой таблице строится долго — поэтому
+# фоном и на отдельном соединении, не занимая пул. Прерванная сборка оставляет
+# INVALID-индекс, который IF NOT EXISTS пропустил бы навсегда: такой удаляем и
+# строим заново (если его прямо сейчас не строит другой процесс).
+async def ensure_search_indexes():
+    conn = await asyncpg.connect(DATABASE_DIRECT_URL)
+    try:
+        for name, ddl in CREATE_SEARCH_INDEXES.items():
+            row = await conn.fetchrow(
+                """
+                SELECT i.indisvalid AS valid,
+                       EXISTS (SELECT 1 FROM pg_stat_progress_create_index p
+                               WHERE p.index_relid = i.indexrelid) AS building
+                FROM pg_index i WHERE i.indexrelid = to_regclass($1)
+                """,
+                name
+            )
+            if row and (row["valid"] or row["building"]):
+                continue
+            t0 = time.perf_counter()
+            if row:
+                logger.warning("Index %s is INVALID (interrupted build), rebuilding", name)
+                await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            await conn.execute(ddl)
+            logger.info("Index %s built in %.1fs", name, time.perf_counter() - t0)
+    except Exception:
+        logger.exception("Search index build failed")
+    finally:
+        await conn.close()
+
+# ============================= Лидер деплоя =============================
+# Advisory lock живёт, пока жива сессия, поэтому для него держим отдельное
+# соединение вне пула (и мимо пулера, см. DATABASE_DIRECT_URL). Ключ лидера
+# зависит от деплоя: новый релиз выбирает своего лидера, даже если воркеры
+# старого ещё дорабатывают.
+# Соединение может оборваться (сеть, рестарт сервера/пулера) — вместе с ним
+# пропадают блокировка и все LISTEN. watch_leadership раз в LEADER_CHECK_S
+# проверяет соединение, при обрыве переподключается и заново пробует стать
+# лидером; фолловеры так же подхватывают лидерство, если лидер пропал.
+LEADER_LOCK_NS = 0x0B0C  # пространство ключей pg_advisory_lock(int, int)
+DEPLOY_ID = os.getenv("RENDER_GIT_COMMIT") or os.getenv("DEPLOY_ID", "local")
+LEADER_CHECK_S = 10
+
+LOCK_CONN: asyncpg.Connection | None = None
+# asyncpg не выполняет две операции на одном соединении одновременно
+LOCK_CONN_LOCK = asyncio.Lock()
+IS_LEADER = False
+LEADER_READY = False  # лидер не только взял блокировку, но и прошёл leader_startup
+LEADER_TASKS: set[asyncio.Task] = set()
+# канал -> (обработчик, только для лидера); после переподключения подписываемся заново
+SESSION_LISTENERS: dict[str, tuple] = {}
+_lock_conn_lost = asyncio.Event()
+_leader_startup_lock = asyncio.Lock()
+
+def spawn_leader(coro) -> asyncio.Task:
+    # фоновая задача лидера: отменяется, если лидерство потеряно
+    task = spawn(coro)
+    LEADER_TASKS.add(task)
+    task.add_done_callback(LEADER_TASKS.discard)
+    return task
+
+async def lock_conn_call(method: str, *args):
+    async with LOCK_CONN_LOCK:
+        if LOCK_CONN is None or LOCK_CONN.is_closed():
+            raise asyncpg.ConnectionDoesNotExistError("leader lock connection is lost")
+        return await getattr(LOCK_CONN, method)(*args)
+
+async def listen(channel: str, callback, leader_only: bool = False):
+    SESSION_LISTENERS[channel] = (callback, leader_only)
+    async with LOCK_CONN_LOCK:
+        if LOCK_CONN is not None and not LOCK_CONN.is_closed():
+            await LOCK_CONN.add_listener(channel, callback)
+
+def on_lock_conn_lost(conn: asyncpg.Connection):
+    global LOCK_CONN
+    if conn is not LOCK_CONN:
+        return  # закрыли сами (resign_leader)
+    logger.error("Leader lock connection lost (leader=%s), reconnecting", IS_LEADER)
+    LOCK_CONN = None
+    lose_leadership()
+    _lock_conn_lost.set()
+
+def lose_leadership():
+    global IS_LEADER, LEADER_READY, DASHBOARD
+    if not IS_LEADER:
+        return
+    IS_LEADER, LEADER_READY, DASHBOARD = False, False, None
+    for channel in [c for c, (_, leader_only) in SESSION_LISTENERS.items() if leader_only]:
+        del SESSION_LISTENERS[channel]
+    for task in list(LEADER_TASKS):
+        task.cancel()
+
+async def elect_leader() -> bool:
+    global LOCK_CONN, IS_LEADER
+    async with LOCK_CONN_LOCK:
+        if LOCK_CONN is None or LOCK_CONN.is_closed():
+            conn = await asyncpg.connect(DATABASE_DIRECT_URL)
+            try:
+                for channel, (callback, _) in SESSION_LISTENERS.items():
+                    await conn.add_listener(channel, callback)
+            except BaseException:
+                await conn.close()
+                raise
+            conn.add_termination_listener(on_lock_conn_lost)
+            LOCK_CONN = conn
+        deploy_key = zlib.crc32(DEPLOY_ID.encode()) & 0x7FFFFFFF
+        IS_LEADER = bool(await LOCK_CONN.fetchval(
+            "SELECT pg_try_advisory_lock($1::int, $2::int)", LEADER_LOCK_NS, deploy_key
+        ))
+    logger.info("Deploy %s: worker %s is %s", DEPLOY_ID, os.getpid(), "leader" if IS_LEADER else "follower")
+    return IS_LEADER
+
+async def drop_lock_conn():
+    global LOCK_CONN
+    async with LOCK_CONN_LOCK:
+        conn, LOCK_CONN = LOCK_CONN, None
+    lose_leadership()
+    if conn is not None:
+        conn.terminate()
+
+async def watch_leadership(bot: Bot):
+    while not DRAINING:
+        for _ in range(LEADER_CHECK_S):
+            if DRAINING or _lock_conn_lost.is_set():
+                break
+            await asyncio.sleep(1)
+        if DRAINING:
+            return
+        _lock_conn_lost.clear()
+        try:
+            if not IS_LEADER:
+                await elect_leader()
+            if IS_LEADER and not LEADER_READY:
+                await start_leading(bot)
+            elif IS_LEADER:
+                await lock_conn_call("fetchval", "SELECT 1")
+        except Exception as e:
+            logger.warning("Leader lock connection check failed: %r", e)
+            await drop_lock_conn()
+            await asyncio.sleep(retry_delay(3))
+
+# Наполовину запущенный лидер хуже никакого: при сбое leader_startup отпускаем
+# блокировку, и watch_leadership выбирает лидера заново (возможно, другой воркер)
+async def start_leading(bot: Bot):
+    global LEADER_READY
+    async with _leader_startup_lock:  # deferred_startup и watch_leadership не запускают его дважды
+        if LEADER_READY or not IS_LEADER:
+            return
+        try:
+            await leader_startup(bot)
+        except Exception:
+            logger.exception("Leader startup failed, giving up leadership")
+            await drop_lock_conn()
+            return
+        LEADER_READY = True
+
+async def resign_leader():
+    global LOCK_CONN, IS_LEADER, LEADER_READY
+    async with LOCK_CONN_LOCK:
+        conn, LOCK_CONN, IS_LEADER, LEADER_READY = LOCK_CONN, None, False, False
+    if conn is None:
+        return
+    try:
+        await conn.close()  # закрытие сессии отпускает advisory lock
+    except Exception:
+        logger.exception("Failed to resign leadership")
+
+# ============================= Лимит конкурентности БД =============================
+# AIMD-лимитер перед пулом: пока сглаженная латентность запросов ниже цели, лимит
+# растёт на 1/limit за запрос, при превышении — умножается на 0.75 (не чаще раза
+# в секунду). Ожидающие обслуживаются по приоритету; низкому приоритету доступна
+# только половина лимита, и он не ждёт вовсе — такие запросы отбрасываются первыми.
+DB_POOL_MAX           = int(os.getenv("DB_POOL_MAX", "5"))
+DB_TARGET_LATENCY_MS  = float(os.getenv("DB_TARGET_LATENCY_MS", "50"))
+DB_ACQUIRE_TIMEOUT_S  = float(os.getenv("DB_ACQUIRE_TIMEOUT_S", "5"))
+
+PRIO_LOW, PRIO_NORMAL, PRIO_HIGH = 0, 1, 2
+DB_WAIT_S = {PRIO_LOW: 0.0, PRIO_NORMAL: 1.0, PRIO_HIGH: 5.0}  # сколько ждать слота
+
+class DbOverloaded(Exception):
+    pass
+
+class AdaptiveLimiter:
+    def __init__(self, max_limit: int, target_s: float, min_limit: int = 1):
+        self.max_limit, self.min_limit, self.target = max_limit, min_limit, target_s
+        self.limit = float(max_limit)
+        self.latency = target_s  # EWMA
+        self.inflight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []  # куча (-priority, seq, future)
+        self._seq = 0
+        self._last_decrease = 0.0
+
+    def _capacity(self, priority: int) -> int:
+        limit = max(int(self.limit), self.min_limit)
+        return max(limit // 2, 1) if priority == PRIO_LOW else limit
+
+    async def acquire(self, priority: int):
+        if not self._waiters and self.inflight < self._capacity(priority):
+            self.inflight += 1
+            return
+        wait = DB_WAIT_S.get(priority, 0.0)
+        if wait <= 0:
+            raise DbOverloaded()
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (-priority, self._seq, fut))
+        self._wake()
+        try:
+            await asyncio.wait_for(fut, timeout=wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                self.release()  # слот уже передан нам, но таймаут или отмена пришли позже
+            if isinstance(e, asyncio.TimeoutError):
+                raise DbOverloaded() from None
+            raise
+
+    def release(self):
+        self.inflight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            priority = -self._waiters[0][0]
+            if self.inflight >= self._capacity(priority):
+                break
+            fut = heapq.heappop(self._waiters)[2]
+            if fut.done():  # ожидание истекло
+                continue
+            self.inflight += 1
+            fut.set_result(None)
+
+    def observe(self, seconds: float):
+        self.latency += 0.2 * (seconds - self.latency)
+        if self.latency > self.target:
+            now = time.monotonic()
+            if now - self._last_decrease >= 1.0:
+                self.limit = max(float(self.min_limit), self.limit * 0.75)
+                self._last_decrease = now
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._wake()
+
+DB_LIMITER = AdaptiveLimiter(DB_POOL_MAX, DB_TARGET_LATENCY_MS / 1000)
+
+async def _init_conn(conn: asyncpg.Connection):
+    conn.add_query_logger(_log_query_time)
 
 @asynccontextmanager
-async def get_conn():
+async def get_conn(priority: int = PRIO_NORMAL):
     assert POOL is not None, "DB pool is not initialized"
-    async with POOL.acquire() as conn:
+    t0 = time.perf_counter()
+    await DB_LIMITER.acquire(priority)
+    try:
+        try:
+            conn = await POOL.acquire(timeout=DB_ACQUIRE_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            raise DbOverloaded() from None
+        except CONN_LOST_ERRORS as e:
+            POOL_HEALTH.failure(e)
+            raise
+        add_phase("db", time.perf_counter() - t0)  # ожидание свободного соединения — тоже время БД
+        try:
+            yield conn
+        except Exception as e:
+            if is_conn_lost(e):
+                POOL_HEALTH.failure(e)
+            raise
+        else:
+            POOL_HEALTH.success()
+        finally:
+            await POOL.release(conn)
+    finally:
+        DB_LIMITER.release()
+
+# ============================= Пулер соединений =============================
+# DB_POOLER=transaction — работа через PgBouncer/Supavisor в transaction mode:
+# серверное соединение меняется между транзакциями, поэтому кеш именованных
+# prepared statements отключаем. Сессионное (advisory lock лидера, LISTEN) через
+# такой пулер не работает и идёт по DATABASE_DIRECT_URL мимо него.
+# Обрыв соединения на чтении повторяем с экспоненциальной задержкой; записи не
+# повторяем — их результат неизвестен. PoolHealth следит за обрывами и сообщает
+# о переходах ok -> degraded -> down.
+DB_POOLER           = os.getenv("DB_POOLER", "").lower()
+DATABASE_DIRECT_URL = os.getenv("DATABASE_DIRECT_URL") or DATABASE_URL
+DB_READ_RETRIES     = int(os.getenv("DB_READ_RETRIES", "3"))
+DB_RETRY_BASE_S     = 0.1
+
+CONN_LOST_ERRORS = (
+    OSError,
+    asyncpg.PostgresConnectionError,  # класс 08, в т.ч. "connection was closed in the middle of operation"
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+    asyncpg.TooManyConnectionsError,
+)
+
+def is_conn_lost(error: BaseException) -> bool:
+    # asyncio.TimeoutError — подкласс OSError, но это таймаут запроса, а не обрыв
+    return isinstance(error, CONN_LOST_ERRORS) and not isinstance(error, asyncio.TimeoutError)
+
+def pool_options() -> dict:
+    if DB_POOLER == "transaction":
+        return {"statement_cache_size": 0}
+    return {}
+
+def retry_delay(attempt: int) -> float:
+    return random.uniform(0, DB_RETRY_BASE_S * 2 ** attempt)  # full jitter
+
+class PoolHealth:
+    def __init__(self, window_s: float = 60, degraded_after: int = 3, down_after: int = 5):
+        self.window_s, self.degraded_after, self.down_after = window_s, degraded_after, down_after
+        self.state = "ok"
+        self.consecutive = 0
+        self.last_error: BaseException | None = None
+        self._lost: deque[float] = deque()
+        self._listeners: list = []
+
+    # callback(previous_state, state) — вызывается синхронно на каждом переходе
+    def subscribe(self, callback):
+        self._listeners.append(callback)
+
+    @property
+    def lost_recently(self) -> int:
+        return len(self._lost)
+
+    def failure(self, error: BaseException):
+        self.consecutive += 1
+        self.last_error = error
+        self._lost.append(time.monotonic())
+        self._update()
+
+    def success(self):
+        if self.consecutive or self.state != "ok":
+            self.consecutive = 0
+            self._update()
+
+    def _update(self):
+        now = time.monotonic()
+        while self._lost and now - self._lost[0] > self.window_s:
+            self._lost.popleft()
+        if self.consecutive >= self.down_after:
+            state = "down"
+        elif len(self._lost) >= self.degraded_after:
+            state = "degraded"
+        else:
+            state = "ok"
+        if state == self.state:
+            return
+        prev, self.state = self.state, state
+        log = logger.info if state == "ok" else logger.warning
+        log("DB pool %s -> %s: %s connections lost in %ss, last error %r",
+            prev, state, len(self._lost), int(self.window_s), self.last_error)
+        for callback in self._listeners:
+            try:
+                callback(prev, state)
+            except Exception:
+                logger.exception("Pool health listener failed")
+
+POOL_HEALTH = PoolHealth()
+
+# Идемпотентное чтение вне unit of work: fn(conn, *args), при обрыве — новое соединение
+async def read_with_retry(fn, *args, priority: int = PRIO_NORMAL, primary: bool = False):
+    for attempt in range(DB_READ_RETRIES + 1):
+        try:
+            async with (get_conn(priority) if primary else get_read_conn(priority)) as conn:
+                return await fn(conn, *args)
+        except CONN_LOST_ERRORS as e:
+            if attempt == DB_READ_RETRIES or not is_conn_lost(e):
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+
+# ============================= Реплика для чтения =============================
+# DATABASE_REPLICA_URL включает второй пул. На него уходят чтения, которые
+# переживут небольшое отставание: доступность столиков, календарь, списки
+# броней, поиск, язык. Каждый воркер раз в REPLICA_LAG_CHECK_S сравнивает LSN
+# primary и реплики; при отставании больше REPLICA_MAX_LAG_S или ошибке всё
+# читается с primary.
+# Read-your-writes: после записи (бронь, статус, язык) в FSM-хранилище
+# пользователя кладётся LSN primary, и пока реплика не проиграла WAL до него,
+# его чтения идут на primary. Хранилище общее для воркеров (FSM_REDIS_URL),
+# поэтому следующий апдейт на другом воркере тоже не увидит старых данных.
+# Если LSN прочитать не удалось — REPLICA_RYW_S + REPLICA_MAX_LAG_S по времени.
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL", "")
+REPLICA_POOL_MAX     = int(os.getenv("REPLICA_POOL_MAX", "5"))
+REPLICA_MAX_LAG_S    = float(os.getenv("REPLICA_MAX_LAG_S", "5"))
+REPLICA_RYW_S        = float(os.getenv("REPLICA_RYW_S", "3"))
+REPLICA_LAG_CHECK_S  = 5
+REPLICA_ACQUIRE_TIMEOUT_S = 0.5
+REPLICA_ERRORS = (asyncio.TimeoutError, OSError, asyncpg.PostgresError, asyncpg.InterfaceError)
+
+REPLICA_POOL: asyncpg.Pool | None = None
+REPLICA_LAG_S: float | None = None  # None — реплика недоступна или ещё не проверена
+REPLICA_REPLAY_LSN = 0  # до какого LSN реплика проиграла WAL при последней проверке
+RYW_DESTINY = "read_your_writes"  # отдельный ключ FSM: state.clear() его не стирает
+
+async def _init_replica_conn(conn: asyncpg.Connection):
+    conn.add_query_logger(lambda record: add_phase("db", record.elapsed))
+
+def parse_lsn(lsn: str) -> int:
+    hi, lo = lsn.split("/")
+    return int(hi, 16) << 32 | int(lo, 16)
+
+def _ryw_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id, destiny=RYW_DESTINY)
+
+# Запоминает позицию WAL после записи; conn — соединение с primary, если оно уже есть
+async def commit_lsn(conn: asyncpg.Connection) -> str | None:
+    # позиция WAL сразу после коммита на том же соединении; без реплики не нужна
+    if REPLICA_POOL is None:
+        return None
+    try:
+        return await conn.fetchval("SELECT pg_current_wal_lsn()::text")
+    except CONN_LOST_ERRORS as e:
+        logger.warning("Cannot read commit LSN: %r", e)
+        return None
+
+async def note_write(*user_ids: int | None, conn: asyncpg.Connection | None = None, lsn: str | None = None):
+    user_ids = {uid for uid in user_ids if uid}
+    if REPLICA_POOL is None or dp is None or not user_ids:
+        return
+    # LSN читаем только на соединении, которое писало: второй слот пула ради
+    # одного SELECT под нагрузкой лишний. Нет LSN — на время читаем с primary
+    if lsn is None and conn is not None and not conn.is_in_transaction():
+        lsn = await commit_lsn(conn)
+    if lsn is not None:
+        mark = {"lsn": lsn}
+    else:
+        logger.warning("No commit LSN, pinning reads to primary for a while")
+        mark = {"until": time.time() + REPLICA_RYW_S + REPLICA_MAX_LAG_S}
+    for uid in user_ids:
+        await dp.storage.set_data(_ryw_key(uid), mark)
+
+async def replica_usable(user_id: int | None = None) -> bool:
+    if REPLICA_POOL is None or REPLICA_LAG_S is None or REPLICA_LAG_S > REPLICA_MAX_LAG_S:
+        return False
+    if not user_id or dp is None:
+        return True
+    mark = await dp.storage.get_data(_ryw_key(user_id))
+    if "lsn" in mark:
+        return REPLICA_REPLAY_LSN >= parse_lsn(mark["lsn"])
+    return time.time() > mark.get("until", 0)
+
+def replica_failed(error: BaseException):
+    global REPLICA_LAG_S
+    if REPLICA_LAG_S is not None:
+        logger.warning("Read replica unavailable, falling back to primary: %r", error)
+    REPLICA_LAG_S = None
+
+@asynccontextmanager
+async def get_replica_conn():
+    assert REPLICA_POOL is not None, "Replica pool is not initialized"
+    t0 = time.perf_counter()
+    async with REPLICA_POOL.acquire(timeout=REPLICA_ACQUIRE_TIMEOUT_S) as conn:
+        add_phase("db", time.perf_counter() - t0)
         yield conn
 
-async def get_lang(user_id: int, fallback: str = "ru") -> str:
-    async with get_conn() as conn:
-        lang = await conn.fetchval("SELECT lang FROM users WHERE user_id=$1", user_id)
-    return lang or fallback
+# Для кода вне апдейтов (панель и т.п.): реплика, если можно, иначе primary
+@asynccontextmanager
+async def get_read_conn(priority: int = PRIO_NORMAL, user_id: int | None = None):
+    async with AsyncExitStack() as stack:
+        conn = None
+        if await replica_usable(user_id):
+            try:
+                conn = await stack.enter_async_context(get_replica_conn())
+            except REPLICA_ERRORS as e:
+                replica_failed(e)
+        if conn is None:
+            conn = await stack.enter_async_context(get_conn(priority))
+        yield conn
 
-async def set_lang(user_id: int, lang: str):
-    if lang not in LANGS:
-        lang = "ru"
-    async with get_conn() as conn:
+async def track_replica_lag():
+    global REPLICA_LAG_S, REPLICA_REPLAY_LSN
+    while not DRAINING:
+        try:
+            async with get_conn(PRIO_LOW) as conn:
+                primary_lsn = await conn.fetchval("SELECT pg_current_wal_lsn()::text")
+            async with REPLICA_POOL.acquire(timeout=REPLICA_ACQUIRE_TIMEOUT_S) as conn:
+                row = await conn.fetchrow(
+                    "SELECT pg_last_wal_replay_lsn() >= $1::text::pg_lsn AS caught_up, "
+                    "pg_last_wal_replay_lsn()::text AS replay_lsn, "
+                    "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8 AS lag",
+                    primary_lsn, timeout=2
+                )
+            if row["replay_lsn"]:
+                REPLICA_REPLAY_LSN = parse_lsn(row["replay_lsn"])
+            lag = 0.0 if row["caught_up"] else (row["lag"] if row["lag"] is not None else REPLICA_MAX_LAG_S + 1)
+            if (REPLICA_LAG_S is None or REPLICA_LAG_S > REPLICA_MAX_LAG_S) and lag <= REPLICA_MAX_LAG_S:
+                logger.info("Read replica is in sync (lag %.2fs), routing reads to it", lag)
+            elif lag > REPLICA_MAX_LAG_S and (REPLICA_LAG_S or 0) <= REPLICA_MAX_LAG_S:
+                logger.warning("Read replica lags %.1fs, reading from primary", lag)
+            REPLICA_LAG_S = lag
+        except DbOverloaded:
+            pass  # primary занят — оставляем прошлую оценку
+        except REPLICA_ERRORS as e:
+            replica_failed(e)
+        for _ in range(REPLICA_LAG_CHECK_S):
+            if DRAINING:
+                return
+            await asyncio.sleep(1)
+
+# ============================= Unit of work =============================
+# Одно соединение на апдейт: берётся лениво при первом запросе и возвращается
+# в пул после хендлера (или раньше — uow.release() перед медленными вызовами
+# Bot API). Язык пользователя читается не больше одного раза за апдейт.
+async def fetch_lang(conn: asyncpg.Connection, user_id: int) -> str | None:
+    return await conn.fetchval("SELECT lang FROM users WHERE user_id=$1", user_id)
+
+class UnitOfWork:
+    def __init__(self, user: User | None, priority: int = PRIO_NORMAL):
+        self.priority = priority
+        self.user_id = user.id if user else None
+        self.tg_lang = pick_default_lang(user.language_code if user else None)
+        self.is_staff = is_staff(self.user_id)
+        self._stored_lang: str | None = None
+        self._lang_loaded = False
+        self._conn: asyncpg.Connection | None = None
+        self._read_conn: asyncpg.Connection | None = None
+        self._stack: AsyncExitStack | None = None
+
+    async def _enter(self, cm) -> asyncpg.Connection:
+        if self._stack is None:
+            self._stack = AsyncExitStack()
+        return await self._stack.enter_async_context(cm)
+
+    async def conn(self, priority: int | None = None) -> asyncpg.Connection:
+        if self._conn is None:
+            self._conn = await self._enter(get_conn(self.priority if priority is None else priority))
+        return self._conn
+
+    # Соединение для чтений, которым допустимо небольшое отставание: реплика, если
+    # она жива и пользователь недавно ничего не писал, иначе — основное соединение
+    async def read_conn(self, priority: int | None = None) -> asyncpg.Connection:
+        if self._conn is not None:
+            return self._conn
+        if self._read_conn is None and await replica_usable(self.user_id):
+            try:
+                self._read_conn = await self._enter(get_replica_conn())
+            except REPLICA_ERRORS as e:
+                replica_failed(e)
+        return self._read_conn or await self.conn(priority)
+
+    # Идемпотентное чтение fn(conn, *args): при обрыве соединение сбрасывается,
+    # и попытка повторяется на новом. Внутри транзакции не повторяем.
+    async def read(self, fn, *args, primary: bool = False, priority: int | None = None):
+        for attempt in range(DB_READ_RETRIES + 1):
+            conn = await (self.conn(priority) if primary else self.read_conn(priority))
+            if conn.is_in_transaction():
+                return await fn(conn, *args)
+            try:
+                return await fn(conn, *args)
+            except CONN_LOST_ERRORS as e:
+                if not is_conn_lost(e):
+                    raise
+                if conn is self._read_conn:
+                    replica_failed(e)
+                await self.release(e)  # get_conn увидит обрыв и отметит его в POOL_HEALTH
+                if attempt == DB_READ_RETRIES:
+                    raise
+                await asyncio.sleep(retry_delay(attempt))
+
+    # read-your-writes: следующие чтения этих пользователей пойдут на primary,
+    # пока реплика не догонит эту запись
+    async def mark_write(self, *user_ids: int | None, lsn: str | None = None):
+        await note_write(self.user_id, *user_ids, conn=self._conn, lsn=lsn)
+
+    async def release(self, error: BaseException | None = None):
+        if self._stack is not None:
+            stack, self._stack, self._conn, self._read_conn = self._stack, None, None, None
+            if error is None:
+                await stack.aclose()
+            else:
+                # ошибку передаём контекстам соединений: get_conn считает обрывы
+                await stack.__aexit__(type(error), error, error.__traceback__)
+
+    @asynccontextmanager
+    async def transaction(self):
+        conn = await self.conn()
+        async with conn.transaction():
+            yield conn
+
+    async def stored_lang(self) -> str | None:
+        if not self._lang_loaded and self.user_id:
+            # язык читается с приоритетом хендлера: это первое чтение, и его соединение
+            # дальше служит всему апдейту. Низкий приоритет под нагрузкой отбрасывался,
+            # и язык интерфейса скакал между сообщениями
+            try:
+                self._stored_lang = await self.read(fetch_lang, self.user_id)
+            except DbOverloaded:
+                return None
+        self._lang_loaded = True
+        return self._stored_lang
+
+    async def lang(self, fallback: str | None = None) -> str:
+        return await self.stored_lang() or fallback or self.tg_lang
+
+    # язык другого пользователя (например, владельца брони) — тем же соединением
+    async def lang_of(self, user_id: int | None, fallback: str = "ru") -> str:
+        if user_id == self.user_id:
+            return await self.lang(fallback)
+        if not user_id:
+            return fallback
+        return await self.read(fetch_lang, user_id, primary=True) or fallback
+
+    async def set_lang(self, lang: str) -> str:
+        if lang not in LANGS:
+            lang = "ru"
+        conn = await self.conn()
         await conn.execute(
             "INSERT INTO users(user_id, lang) VALUES($1,$2) "
             "ON CONFLICT (user_id) DO UPDATE SET lang=$2",
-            user_id, lang
+            self.user_id, lang
         )
+        self._stored_lang, self._lang_loaded = lang, True
+        await self.mark_write()
+        return lang
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        note_handler(data)
+        priority = get_flag(data, "db_priority", default=PRIO_NORMAL)
+        uow = data["uow"] = UnitOfWork(data.get("event_from_user"), priority)
+        try:
+            result = await handler(event, data)
+        except BaseException as e:
+            await uow.release(e)
+            raise
+        await uow.release()
+        return result
 
 # ============================= Утилиты для длинных сообщений =============================
 MAX_TG = 3900  # запас ниже лимита 4096
@@ -497,6 +1616,197 @@ async def safe_edit_text(message: Message, text: str, reply_markup=None):
         await message.answer("⤵️ Продолжение:")
         return await safe_send_text(message.bot, message.chat.id, text, reply_markup)
 
+# ============================= Диагностика =============================
+# Лог медленных апдейтов: если feed_update дольше SLOW_UPDATE_MS, пишем хендлер,
+# тип апдейта и разбивку времени на БД, Bot API и всё остальное (рендер/логика).
+# Время копится в словаре, который лежит в ContextVar на время апдейта.
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1500"))
+
+_phases: ContextVar[dict | None] = ContextVar("update_phases", default=None)
+
+def add_phase(name: str, seconds: float):
+    phases = _phases.get()
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+def note_handler(data: dict):
+    phases = _phases.get()
+    handler = data.get("handler")
+    if phases is not None and handler is not None:
+        phases["handler"] = getattr(handler.callback, "__name__", repr(handler.callback))
+
+# asyncpg вызывает логгер через call_soon, контекст апдейта при этом копируется
+def _log_query_time(record):
+    add_phase("db", record.elapsed)
+    DB_LIMITER.observe(record.elapsed)
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            add_phase("api", time.perf_counter() - t0)
+
+class SlowUpdateMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data):
+        phases: dict = {}
+        token = _phases.set(phases)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            _phases.reset(token)
+            total = time.perf_counter() - t0
+            if total * 1000 >= SLOW_UPDATE_MS:
+                db, api = phases.get("db", 0.0), phases.get("api", 0.0)
+                logger.warning(
+                    "Slow update %s (%s): total=%.0fms handler=%s db=%.0fms api=%.0fms render/other=%.0fms",
+                    event.update_id, event.event_type, total * 1000, phases.get("handler", "—"),
+                    db * 1000, api * 1000, max(total - db - api, 0.0) * 1000,
+                )
+
+# Сэмплирующий профайлер: отдельный поток раз в PROFILE_INTERVAL_MS снимает стек
+# потока event loop и считает одинаковые стеки. Хендлеры не инструментируются,
+# поэтому накладные расходы — только на снятие стека.
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_ON_START_S  = int(os.getenv("PROFILE_ON_START_S", "0"))  # >0 — профилировать первые N секунд после старта
+PROFILE_MAX_S       = 600
+PROFILE_TOP         = 30
+
+class SamplingProfiler:
+    def __init__(self, interval_s: float):
+        self.interval = interval_s
+        self.samples = 0
+        self.stacks: Counter[str] = Counter()
+        self._target = threading.get_ident()  # создавать из потока event loop
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < 64:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    # Топ горячих стеков и следом все стеки в folded-формате (flamegraph.pl, speedscope)
+    def report(self, seconds: float) -> str:
+        lines = [f"# {self.samples} samples over {seconds:.1f}s, interval {self.interval * 1000:.0f}ms", ""]
+        for stack, n in self.stacks.most_common(PROFILE_TOP):
+            lines.append(f"{n * 100 / max(self.samples, 1):5.1f}%  {n}")
+            lines.extend(f"    {f}" for f in reversed(stack.split(";")[-15:]))
+            lines.append("")
+        lines.append("# folded stacks")
+        lines.extend(f"{stack} {n}" for stack, n in self.stacks.most_common())
+        return "\n".join(lines)
+
+_profiling = False
+
+async def run_profile(bot: Bot, chat_id: int | None, seconds: int):
+    global _profiling
+    if _profiling:
+        return False
+    _profiling = True
+    prof = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+    started = time.monotonic()
+    prof.start()
+    try:
+        while time.monotonic() - started < seconds and not DRAINING:
+            await asyncio.sleep(1)
+    finally:
+        prof.stop()
+        _profiling = False
+    elapsed = time.monotonic() - started
+    report = prof.report(elapsed)
+    name = f"profile-{os.getpid()}-{datetime.now(UTC):%Y%m%d-%H%M%S}.txt"
+    if chat_id:
+        await bot.send_document(chat_id, BufferedInputFile(report.encode(), filename=name),
+                                caption=f"Профиль: {elapsed:.0f} с, {prof.samples} сэмплов")
+    else:
+        logger.info("Profile %s:\n%s", name, report)
+    return True
+
+# ============================= Анти-флуд =============================
+# Token bucket на пользователя. Корзины лежат в LRU фиксированного размера:
+# обращение — move_to_end, вытеснение самого давно неактивного — popitem, оба O(1).
+FLOOD_RATE        = float(os.getenv("FLOOD_RATE", "1"))         # токенов в секунду
+FLOOD_BURST       = float(os.getenv("FLOOD_BURST", "5"))
+FLOOD_STAFF_RATE  = float(os.getenv("FLOOD_STAFF_RATE", "5"))
+FLOOD_STAFF_BURST = float(os.getenv("FLOOD_STAFF_BURST", "30"))
+FLOOD_MAX_USERS   = int(os.getenv("FLOOD_MAX_USERS", "20000"))
+FLOOD_DUP_CB_S    = float(os.getenv("FLOOD_DUP_CB_S", "2"))      # окно склейки одинаковых коллбеков
+
+class _Bucket:
+    __slots__ = ("tokens", "ts", "cb_key", "cb_ts", "warned")
+
+    def __init__(self, tokens: float, ts: float):
+        self.tokens, self.ts = tokens, ts
+        self.cb_key, self.cb_ts = None, 0.0
+        self.warned = False
+
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self, max_users: int = FLOOD_MAX_USERS):
+        self.max_users = max_users
+        self._buckets: OrderedDict[int, _Bucket] = OrderedDict()
+
+    def _bucket(self, user_id: int, now: float, burst: float) -> _Bucket:
+        b = self._buckets.get(user_id)
+        if b is None:
+            if len(self._buckets) >= self.max_users:
+                self._buckets.popitem(last=False)
+            b = self._buckets[user_id] = _Bucket(burst, now)
+        else:
+            self._buckets.move_to_end(user_id)
+        return b
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        now = time.monotonic()
+        if is_staff(user.id):
+            rate, burst = FLOOD_STAFF_RATE, FLOOD_STAFF_BURST
+        else:
+            rate, burst = FLOOD_RATE, FLOOD_BURST
+        b = self._bucket(user.id, now, burst)
+
+        # повторные нажатия той же кнопки — просто гасим «часики» и выходим
+        if isinstance(event, CallbackQuery):
+            cb_key = (event.message.message_id if event.message else None, event.data)
+            if cb_key == b.cb_key and now - b.cb_ts < FLOOD_DUP_CB_S:
+                b.cb_ts = now
+                return await event.answer()
+            b.cb_key, b.cb_ts = cb_key, now
+
+        b.tokens = min(burst, b.tokens + (now - b.ts) * rate)
+        b.ts = now
+        if b.tokens < 1:
+            return await self._reject(event, b, pick_default_lang(user.language_code))
+        b.tokens -= 1
+        b.warned = False
+        return await handler(event, data)
+
+    # язык берём из Telegram, а не из users: троттлинг не должен ходить в БД
+    async def _reject(self, event, b: _Bucket, lang: str):
+        if isinstance(event, CallbackQuery):
+            return await event.answer(T(lang, "err_flood"))
+        if not b.warned and isinstance(event, Message):
+            b.warned = True  # одно предупреждение на серию, дальше молча отбрасываем
+            await event.answer(T(lang, "err_flood"))
+
 # ============================= Клавиатуры =============================
 def main_kb(lang: str, user_id: int | None = None, chat_id: int | None = None, chat_type: str | None = None) -> ReplyKeyboardMarkup:
     rows = [
@@ -526,6 +1836,17 @@ async def auto_leave(msg: Message, bot: Bot):
 
 @guard.my_chat_member()
 async def on_added(ev: ChatMemberUpdated, bot: Bot):
+    if ev.chat.type == "private":
+        # гость заблокировал/разблокировал бота — рассылки его пропускают или снова включают
+        try:
+            async with get_conn(PRIO_LOW) as conn:
+                await conn.execute(
+                    "UPDATE users SET blocked_at = CASE WHEN $2 THEN now() END WHERE user_id=$1",
+                    ev.chat.id, ev.new_chat_member.status == "kicked"
+                )
+        except (DbOverloaded, *CONN_LOST_ERRORS):
+            pass
+        return
     if ev.chat.type in {"group", "supergroup"} and ev.chat.id != ADMIN_CHAT_ID:
         new_status = ev.new_chat_member.status
         if new_status in {"member", "administrator"}:
@@ -539,6 +1860,11 @@ class BookingForm(StatesGroup):
     waiting_for_name = State()
     waiting_for_phone = State()
 
+class WaitlistForm(StatesGroup):
+    waiting_for_window = State()
+    waiting_for_name = State()
+    waiting_for_phone = State()
+
 class AdminDelete(StatesGroup):
     waiting_for_id = State()
 
@@ -586,44 +1912,612 @@ def parse_guests_localized(value: str, lang: str) -> int:
     return n
 
 # ============================= Статусы =============================
-async def set_status(booking_id: int, new_status: str) -> tuple[int | None, int | None]:
-    async with get_conn() as conn:
-        row = await conn.fetchrow(
-            "UPDATE bookings SET status=$1 WHERE id=$2 RETURNING id, user_id",
-            new_status, booking_id
-        )
+async def set_status(conn: asyncpg.Connection, booking_id: int, new_status: str) -> tuple[int | None, int | None]:
+    row = await conn.fetchrow(
+        """
+        WITH b AS (UPDATE bookings SET status=$1 WHERE id=$2 RETURNING *),
+             e AS (INSERT INTO booking_events(booking_id, kind, booking) SELECT id, 'status', to_jsonb(b) FROM b)
+        SELECT id, user_id FROM b
+        """,
+        new_status, booking_id
+    )
     if row:
         return row["id"], row["user_id"]
     return None, None
 
+async def delete_booking(conn: asyncpg.Connection, booking_id: int) -> bool:
+    row = await conn.fetchrow(
+        """
+        WITH b AS (DELETE FROM bookings WHERE id=$1 RETURNING *),
+             e AS (INSERT INTO booking_events(booking_id, kind, booking) SELECT id, 'deleted', to_jsonb(b) FROM b)
+        SELECT id FROM b
+        """,
+        booking_id
+    )
+    return row is not None
+
+# ============================= Запись броней =============================
+# Порядок колонок для unnest(...) в INSERT_BOOKINGS
+BOOKING_COLUMNS = ("user_id", "name", "phone", "booking_date", "booking_time",
+                   "guests", "table_id", "created_at", "duration_min")
+
+# RETURNING не гарантирует порядок строк, но id из serial выдаются в порядке
+# вставки (ORDER BY ord), поэтому отсортированные id соответствуют строкам пачки.
+# Событие 'created' для ленты пишется тем же запросом.
+INSERT_BOOKINGS = """
+WITH ins AS (
+    INSERT INTO bookings
+      (user_id, name, phone, booking_date, booking_time, guests, table_id, created_at, status, duration_min)
+    SELECT u.user_id, u.name, u.phone, u.booking_date, u.booking_time, u.guests, u.table_id, u.created_at, 'new', u.duration_min
+    FROM unnest($1::bigint[], $2::text[], $3::text[], $4::date[], $5::time[],
+                $6::int[], $7::int[], $8::timestamptz[], $9::int[])
+         WITH ORDINALITY AS u(user_id, name, phone, booking_date, booking_time, guests, table_id, created_at, duration_min, ord)
+    ORDER BY u.ord
+    RETURNING *
+), ev AS (
+    INSERT INTO booking_events(booking_id, kind, booking)
+    SELECT id, 'created', to_jsonb(ins) FROM ins ORDER BY id
+)
+SELECT id FROM ins
+"""
+
+def _minutes(t: _time) -> int:
+    return t.hour * 60 + t.minute
+
+# Вставляет пачку броней с проверкой пересечений по столикам; вызывать внутри транзакции.
+# Возвращает id для каждой строки или None, если столик на это время уже занят
+# или такого столика нет (подделанный callback, table_id=0) — без FK-ошибки на всю пачку.
+async def insert_bookings(conn: asyncpg.Connection, rows: list[dict]) -> list[int | None]:
+    table_ids = sorted({r["table_id"] for r in rows})
+    dates = sorted({r["booking_date"] for r in rows})
+    # блокировка строк tables сериализует конкурирующие записи на один столик
+    locked = {r["id"] for r in await conn.fetch(
+        "SELECT id FROM tables WHERE id = ANY($1::int[]) ORDER BY id FOR UPDATE", table_ids
+    )}
+    busy = await conn.fetch(
+        """
+        SELECT table_id, booking_date, booking_time, duration_min
+        FROM bookings
+        WHERE table_id = ANY($1::int[]) AND booking_date = ANY($2::date[])
+          AND status IN ('new','confirmed','held')
+        """,
+        table_ids, dates
+    )
+    occupied: dict[tuple[int, _date], list[tuple[int, int]]] = {}
+    for b in busy:
+        start = _minutes(b["booking_time"])
+        occupied.setdefault((b["table_id"], b["booking_date"]), []).append((start, start + b["duration_min"]))
+
+    accepted: list[int] = []
+    for i, r in enumerate(rows):
+        if r["table_id"] not in locked:
+            continue
+        start = _minutes(r["booking_time"])
+        end = start + r["duration_min"]
+        slots = occupied.setdefault((r["table_id"], r["booking_date"]), [])
+        if any(s < end and e > start for s, e in slots):
+            continue
+        slots.append((start, end))  # учитываем и брони из этой же пачки
+        accepted.append(i)
+
+    result: list[int | None] = [None] * len(rows)
+    if accepted:
+        columns = [[rows[i][c] for i in accepted] for c in BOOKING_COLUMNS]
+        ids = sorted(r["id"] for r in await conn.fetch(INSERT_BOOKINGS, *columns))
+        for i, booking_id in zip(accepted, ids):
+            result[i] = booking_id
+    return result
+
+# Group commit: при всплесках брони из конкурентных хендлеров копятся несколько
+# миллисекунд и пишутся одной транзакцией (один WAL flush на пачку). Одиночная
+# бронь пишется сразу; окно BOOKING_GROUP_COMMIT_MS ждём, только когда в очереди
+# уже есть другие (в том числе накопившиеся за время предыдущей записи).
+BOOKING_GROUP_COMMIT_MS = float(os.getenv("BOOKING_GROUP_COMMIT_MS", "0"))  # 0 — выключено
+BOOKING_GROUP_MAX       = int(os.getenv("BOOKING_GROUP_MAX", "200"))
+
+class BookingWriter:
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = spawn(self._run())
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def submit(self, row: dict) -> tuple[int | None, str | None]:
+        # id брони и LSN её коммита (для read-your-writes; без реплики — None)
+        if not self.running:  # писатель уже остановлен (drain) — пишем напрямую
+            async with get_conn(PRIO_HIGH) as conn:
+                async with conn.transaction():
+                    booking_id = (await insert_bookings(conn, [row]))[0]
+                return booking_id, await commit_lsn(conn)
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((row, fut))
+        booking_id, lsn = await fut
+        return booking_id, await lsn
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch: list[tuple[dict, asyncio.Future]] = []
+        try:
+            while True:
+                try:
+                    batch = [await asyncio.wait_for(self._queue.get(), timeout=0.5)]
+                except asyncio.TimeoutError:
+                    if DRAINING:
+                        return
+                    continue
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                # окно ждём, только если есть реальная конкуренция: одиночная бронь
+                # пишется сразу, без лишней задержки
+                deadline = loop.time() + self.window
+                while 1 < len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                    except asyncio.TimeoutError:
+                        break
+                await self._flush(batch)
+                batch = []
+        finally:
+            # отменены на дедлайне drain — ждущие хендлеры получают отказ, а не висят
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(DbOverloaded())
+
+    async def _flush(self, batch: list[tuple[dict, asyncio.Future]]):
+        committed = False
+        lsn = asyncio.get_running_loop().create_future()
+        try:
+            async with get_conn(PRIO_HIGH) as conn:
+                async with conn.transaction():
+                    ids = await insert_bookings(conn, [row for row, _ in batch])
+                committed = True
+                # закоммичено: отдаём результат до возврата соединения в пул, иначе
+                # отмена на этом await превратит записанные брони в отказ
+                for (_, fut), booking_id in zip(batch, ids):
+                    if not fut.done():
+                        fut.set_result((booking_id, lsn))
+                lsn.set_result(await commit_lsn(conn))
+        except Exception as e:
+            if committed:  # упал только возврат соединения — брони уже записаны
+                logger.warning("Group commit of %s bookings: connection release failed: %r", len(batch), e)
+                return
+            if len(batch) > 1 and isinstance(e, asyncpg.PostgresError) and not isinstance(e, CONN_LOST_ERRORS):
+                # плохая строка не должна ронять брони остальных — пишем по одной
+                logger.warning("Group commit of %s bookings failed (%r), inserting one by one", len(batch), e)
+                for item in batch:
+                    await self._flush([item])
+                return
+            logger.exception("Group commit of %s bookings failed", len(batch))
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        finally:
+            if not lsn.done():  # отменены после коммита — хендлеры не ждут LSN
+                lsn.set_result(None)
+        logger.info("Group commit: %s bookings", len(batch))
+
+BOOKING_WRITER: BookingWriter | None = None
+
+# ============================= Панель загрузки =============================
+# Закреплённое сообщение в ADMIN_CHAT_ID с сегодняшней загрузкой столиков.
+# Изменения копятся: после первого изменения ждём DASHBOARD_DEBOUNCE_S тишины,
+# а между правками выдерживаем DASHBOARD_MIN_INTERVAL_S. Если текст не
+# изменился, edit_message_text не вызываем вовсе. Работает на лидере.
+DASHBOARD_DEBOUNCE_S     = float(os.getenv("DASHBOARD_DEBOUNCE_S", "5"))
+DASHBOARD_MIN_INTERVAL_S = float(os.getenv("DASHBOARD_MIN_INTERVAL_S", "20"))
+DASHBOARD_REFRESH_S      = 300  # перерисовка без изменений — для смены дня
+DASHBOARD_SLOT_MIN       = 30
+
+STATUS_MARKS = {"new": "▒", "held": "▒", "confirmed": "▓"}
+
+async def render_dashboard(conn: asyncpg.Connection, day: _date) -> str:
+    rows = await conn.fetch(
+        """
+        SELECT t.id, t.title, t.seats, b.booking_time, b.duration_min, b.status
+        FROM tables t
+        LEFT JOIN bookings b
+               ON b.table_id = t.id AND b.booking_date = $1 AND b.status IN ('new','confirmed','held')
+        WHERE t.is_active = TRUE
+        ORDER BY t.id, b.booking_time
+        """,
+        day
+    )
+    counts = dict(await conn.fetch(
+        "SELECT status, COUNT(*) FROM bookings WHERE booking_date = $1 GROUP BY status", day
+    ))
+
+    open_m, close_m = _minutes(OPEN_TIME), _minutes(CLOSE_TIME)
+    n_slots = (close_m - open_m) // DASHBOARD_SLOT_MIN
+    timelines: dict[int, tuple[str, list[str]]] = {}
+    for r in rows:
+        title, line = timelines.setdefault(r["id"], (f"{r['title'][:10]} ({r['seats']})", ["░"] * n_slots))
+        if r["booking_time"] is None:
+            continue
+        start = _minutes(r["booking_time"])
+        for i in range(n_slots):
+            slot = open_m + i * DASHBOARD_SLOT_MIN
+            if start <= slot < start + r["duration_min"]:
+                line[i] = STATUS_MARKS[r["status"]]
+
+    width = max((len(t) for t, _ in timelines.values()), default=0)
+    hours = "".join(f"{h:<{60 // DASHBOARD_SLOT_MIN * 2}}" for h in range(OPEN_TIME.hour, CLOSE_TIME.hour, 2))
+    lines = [
+        f"📊 Загрузка на {day:%d.%m.%Y}",
+        f"Новые: {counts.get('new', 0)} · Подтверждённые: {counts.get('confirmed', 0)} · "
+        f"Отменённые: {counts.get('cancelled', 0)}",
+        "",
+        f"<code>{' ' * width}  {hours}</code>",
+    ]
+    for title, line in timelines.values():
+        lines.append(f"<code>{html.escape(title.ljust(width))}  {''.join(line)}</code>")
+    lines.append("")
+    lines.append("░ свободно · ▒ новая · ▓ подтверждена")
+    return "\n".join(lines)
+
+class Dashboard:
+    def __init__(self, bot: Bot, chat_id: int):
+        self.bot, self.chat_id = bot, chat_id
+        self.message_id: int | None = None
+        self._dirty = asyncio.Event()
+        self._last_text: str | None = None
+        self._last_edit = 0.0
+
+    def mark_dirty(self):
+        self._dirty.set()
+
+    async def run(self):
+        try:
+            async with get_conn(PRIO_LOW) as conn:
+                value = await conn.fetchval("SELECT value FROM bot_state WHERE key='dashboard_message_id'")
+            self.message_id = int(value) if value else None
+        except Exception:
+            logger.exception("Cannot load dashboard message id")
+        self._dirty.set()
+        while not DRAINING:
+            try:
+                await asyncio.wait_for(self._dirty.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                if time.monotonic() - self._last_edit < DASHBOARD_REFRESH_S:
+                    continue
+            delay = max(DASHBOARD_DEBOUNCE_S, DASHBOARD_MIN_INTERVAL_S - (time.monotonic() - self._last_edit))
+            await asyncio.sleep(delay)
+            self._dirty.clear()
+            try:
+                await self.refresh()
+            except DbOverloaded:
+                self._dirty.set()  # попробуем на следующем круге
+            except Exception:
+                logger.exception("Dashboard refresh failed")
+            self._last_edit = time.monotonic()
+
+    async def refresh(self):
+        text = await read_with_retry(render_dashboard, _date.today(), priority=PRIO_LOW)
+        if text == self._last_text:
+            return
+        if self.message_id:
+            try:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logger.warning("Dashboard message %s is gone (%s), posting a new one", self.message_id, e)
+                    self.message_id = None
+        if not self.message_id:
+            msg = await self.bot.send_message(self.chat_id, text)
+            self.message_id = msg.message_id
+            try:
+                await self.bot.pin_chat_message(self.chat_id, msg.message_id, disable_notification=True)
+            except TelegramBadRequest as e:
+                logger.warning("Cannot pin dashboard message: %s", e)
+            async with get_conn(PRIO_LOW) as conn:
+                await conn.execute(
+                    "INSERT INTO bot_state(key, value) VALUES('dashboard_message_id', $1) "
+                    "ON CONFLICT (key) DO UPDATE SET value=$1",
+                    str(msg.message_id)
+                )
+        self._last_text = text
+
+DASHBOARD: Dashboard | None = None
+
+# ============================= Календарь =============================
+# Доступность дней месяца считается из одного агрегирующего запроса на месяц:
+# для каждого активного столика — занятые интервалы по дням. Результат не
+# зависит от числа гостей, поэтому кешируется на месяц и сбрасывается по
+# NOTIFY bookings_changed (с TTL на случай потери LISTEN-соединения).
+CALENDAR_TTL_S        = float(os.getenv("CALENDAR_TTL_S", "120"))
+CALENDAR_MONTHS_AHEAD = 6
+CALENDAR_SLOT_MIN     = 30
+
+_calendar_cache: dict[tuple[int, int], tuple[float, dict]] = {}
+_calendar_gen: dict[tuple[int, int], int] = {}
+_calendar_changed: dict[tuple[int, int], float] = {}
+
+def invalidate_calendar(day: _date):
+    key = (day.year, day.month)
+    _calendar_cache.pop(key, None)
+    _calendar_gen[key] = _calendar_gen.get(key, 0) + 1
+    _calendar_changed[key] = time.monotonic()
+
+def calendar_month_allowed(year: int, month: int) -> bool:
+    today = _date.today()
+    offset = (year - today.year) * 12 + (month - today.month)
+    return 0 <= offset <= CALENDAR_MONTHS_AHEAD
+
+async def fetch_month_busy(conn: asyncpg.Connection, first: _date, last: _date) -> list:
+    return await conn.fetch(
+        """
+        SELECT t.id, t.seats, b.booking_date,
+               array_agg(b.booking_time ORDER BY b.booking_time) AS starts,
+               array_agg(b.duration_min ORDER BY b.booking_time) AS durations
+        FROM tables t
+        LEFT JOIN bookings b
+               ON b.table_id = t.id AND b.booking_date BETWEEN $1 AND $2
+              AND b.status IN ('new','confirmed','held')
+        WHERE t.is_active = TRUE
+        GROUP BY t.id, t.seats, b.booking_date
+        """,
+        first, last
+    )
+
+async def calendar_month(uow: UnitOfWork, year: int, month: int) -> dict:
+    key = (year, month)
+    hit = _calendar_cache.get(key)
+    if hit and time.monotonic() - hit[0] < CALENDAR_TTL_S:
+        return hit[1]
+    gen = _calendar_gen.get(key, 0)
+    first = _date(year, month, 1)
+    last = _date(year, month, _calendar.monthrange(year, month)[1])
+    # месяц только что менялся — реплика может ещё не догнать, а результат попадёт в общий кеш
+    fresh = time.monotonic() - _calendar_changed.get(key, -1e9) < REPLICA_RYW_S + (REPLICA_LAG_S or 0)
+    rows = await uow.read(fetch_month_busy, first, last, primary=fresh)
+    tables: dict[int, int] = {}
+    busy: dict[tuple[_date, int], list[tuple[int, int]]] = {}
+    for r in rows:
+        tables[r["id"]] = r["seats"]
+        if r["booking_date"] is not None:
+            busy[(r["booking_date"], r["id"])] = [
+                (_minutes(s), _minutes(s) + d) for s, d in zip(r["starts"], r["durations"])
+            ]
+    data = {"tables": tables, "busy": busy}
+    if _calendar_gen.get(key, 0) == gen:  # пока читали, месяц не инвалидировали
+        _calendar_cache[key] = (time.monotonic(), data)
+    return data
+
+# "free" / "limited" / "full": доля свободных пар (столик, время начала) среди подходящих столиков
+def day_availability(month: dict, day: _date, guests: int) -> str:
+    eligible = [tid for tid, seats in month["tables"].items() if seats >= guests]
+    starts = range(_minutes(OPEN_TIME), _minutes(CLOSE_TIME) + 1, CALENDAR_SLOT_MIN)
+    total = len(eligible) * len(starts)
+    free = 0
+    for tid in eligible:
+        intervals = month["busy"].get((day, tid), ())
+        for s in starts:
+            if not any(bs < s + DURATION_MIN and be > s for bs, be in intervals):
+                free += 1
+    if free == 0:
+        return "full"
+    return "limited" if free * 2 < total else "free"
+
+def calendar_kb(lang: str, year: int, month: int, month_data: dict, guests: int) -> InlineKeyboardMarkup:
+    today = _date.today()
+    months = T(lang, "cal_months").split(",")
+    prev_y, prev_m = (year, month - 1) if month > 1 else (year - 1, 12)
+    next_y, next_m = (year, month + 1) if month < 12 else (year + 1, 1)
+    rows = [[
+        InlineKeyboardButton(text="‹" if calendar_month_allowed(prev_y, prev_m) else " ",
+                             callback_data=f"cal:m:{prev_y}-{prev_m:02d}"),
+        InlineKeyboardButton(text=f"{months[month - 1]} {year}", callback_data="cal:nop"),
+        InlineKeyboardButton(text="›" if calendar_month_allowed(next_y, next_m) else " ",
+                             callback_data=f"cal:m:{next_y}-{next_m:02d}"),
+    ], [InlineKeyboardButton(text=w, callback_data="cal:nop") for w in T(lang, "cal_weekdays").split(",")]]
+    for week in _calendar.monthcalendar(year, month):
+        row = []
+        for n in week:
+            if n == 0 or _date(year, month, n) < today:
+                row.append(InlineKeyboardButton(text=" " if n == 0 else "·", callback_data="cal:nop"))
+                continue
+            d = _date(year, month, n)
+            avail = day_availability(month_data, d, guests)
+            if avail == "full":
+                row.append(InlineKeyboardButton(text="×", callback_data="cal:full"))
+            else:
+                label = f"{n}*" if avail == "limited" else str(n)
+                row.append(InlineKeyboardButton(text=label, callback_data=f"cal:d:{d.isoformat()}"))
+        rows.append(row)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# ============================= Лента изменений =============================
+# GET /feed/bookings?cursor=...&wait=25 с заголовком "Authorization: Bearer FEED_TOKEN"
+# отдаёт события booking_events после курсора. Курсор непрозрачный ("txid-id");
+# пустой — с самого старого хранимого события. При wait>0 пустой ответ
+# откладывается, пока не придёт NOTIFY bookings_changed или не истечёт wait.
+#
+# Отдаются только события транзакций старше xmin текущего снимка: все, что ниже,
+# уже завершены, и новое событие с меньшим (txid, id) появиться не может.
+# Лидер раз в час удаляет события старше FEED_RETENTION_DAYS (без FEED_TOKEN —
+# все, события пишутся всегда). Удаляется чистый префикс порядка (txid, id) не
+# выше xmin, так что курсор либо видит все события после себя, либо старше
+# удалённой границы и получает 410 — потребителю нужно перечитать всё заново.
+FEED_TOKEN          = os.getenv("FEED_TOKEN", "")
+FEED_RETENTION_DAYS = int(os.getenv("FEED_RETENTION_DAYS", "30"))
+FEED_PAGE_MAX       = 500
+FEED_WAIT_MAX_S     = 25.0
+FEED_PRUNE_EVERY_S  = 3600
+FEED_PRUNE_BATCH    = 5000
+
+_feed_wake = asyncio.Event()
+
+def wake_feed():
+    global _feed_wake
+    _feed_wake.set()
+    _feed_wake = asyncio.Event()
+
+def parse_feed_cursor(cursor: str) -> tuple[int, int] | None:
+    if not cursor:
+        return (0, 0)
+    m = re.fullmatch(r"(\d+)-(\d+)", cursor)
+    return (int(m[1]), int(m[2])) if m else None
+
+async def fetch_feed(conn: asyncpg.Connection, after: tuple[int, int], limit: int):
+    pruned = parse_feed_cursor(await conn.fetchval(
+        "SELECT value FROM bot_state WHERE key='feed_pruned_to'"
+    ) or "")
+    if after != (0, 0) and after < pruned:
+        return None
+    return await conn.fetch(
+        """
+        SELECT id, txid, booking_id, kind, booking::text AS booking, created_at
+        FROM booking_events
+        WHERE (txid, id) > ($1, $2)
+          AND txid < pg_snapshot_xmin(pg_current_snapshot())::text::bigint
+        ORDER BY txid, id
+        LIMIT $3
+        """,
+        after[0], after[1], limit
+    )
+
+@app.get("/feed/bookings")
+async def booking_feed(request: Request, cursor: str = "", wait: float = 0, limit: int = 100):
+    if not FEED_TOKEN:
+        return Response(status_code=404)
+    auth = request.headers.get("authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {FEED_TOKEN}".encode()):
+        return Response(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    after = parse_feed_cursor(cursor)
+    if after is None:
+        return Response("bad cursor", status_code=400)
+    limit = min(max(limit, 1), FEED_PAGE_MAX)
+    deadline = time.monotonic() + min(max(wait, 0.0), FEED_WAIT_MAX_S)
+    while True:
+        wake = _feed_wake
+        try:
+            rows = await read_with_retry(fetch_feed, after, limit, priority=PRIO_LOW, primary=True)
+        except (DbOverloaded, *CONN_LOST_ERRORS):
+            return Response(status_code=503, headers={"Retry-After": "1"})
+        if rows is None:
+            return Response("cursor is older than retention, start over with an empty cursor", status_code=410)
+        if rows or DRAINING or time.monotonic() >= deadline:
+            break
+        # ждём NOTIFY; раз в секунду проверяем DRAINING, чтобы не держать редеплой
+        while not wake.is_set() and not DRAINING and time.monotonic() < deadline:
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=min(1.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+    if rows:
+        after = (rows[-1]["txid"], rows[-1]["id"])
+    return {
+        "cursor": f"{after[0]}-{after[1]}",
+        "more": len(rows) == limit,
+        "events": [
+            {
+                "id": r["id"],
+                "booking_id": r["booking_id"],
+                "kind": r["kind"],
+                "at": r["created_at"].isoformat(),
+                "booking": json.loads(r["booking"]),
+            }
+            for r in rows
+        ],
+    }
+
+async def prune_booking_events():
+    while not DRAINING:
+        days = FEED_RETENTION_DAYS if FEED_TOKEN else 0  # ленту никто не читает — не копим
+        try:
+            async with get_conn(PRIO_LOW) as conn:
+                # граница — первое событие, которое храним, но не выше xmin: ниже неё
+                # новых событий уже не появится, и лента могла отдать их все
+                keep = await conn.fetchrow(
+                    """
+                    SELECT txid, id FROM booking_events
+                    WHERE created_at >= now() - make_interval(days => $1)
+                    ORDER BY txid, id LIMIT 1
+                    """,
+                    days
+                )
+                xmin = await conn.fetchval("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+                limit = min((keep["txid"], keep["id"]) if keep else (xmin, 0), (xmin, 0))
+                while not DRAINING:
+                    async with conn.transaction():
+                        rows = await conn.fetch(
+                            """
+                            DELETE FROM booking_events WHERE id IN (
+                                SELECT id FROM booking_events
+                                WHERE (txid, id) < ($1, $2)
+                                ORDER BY txid, id
+                                LIMIT $3
+                            )
+                            RETURNING txid, id
+                            """,
+                            limit[0], limit[1], FEED_PRUNE_BATCH
+                        )
+                        if rows:
+                            edge = max((r["txid"], r["id"]) for r in rows)
+                            stored = parse_feed_cursor(await conn.fetchval(
+                                "SELECT value FROM bot_state WHERE key='feed_pruned_to'"
+                            ) or "")
+                            await conn.execute(
+                                "INSERT INTO bot_state(key, value) VALUES('feed_pruned_to', $1) "
+                                "ON CONFLICT (key) DO UPDATE SET value=$1",
+                                "%s-%s" % max(edge, stored)
+                            )
+                    if rows:
+                        logger.info("Pruned %s booking events", len(rows))
+                    if len(rows) < FEED_PRUNE_BATCH:
+                        break
+        except DbOverloaded:
+            pass  # попробуем в следующий раз
+        except Exception:
+            logger.exception("Booking events pruning failed")
+        for _ in range(FEED_PRUNE_EVERY_S):
+            if DRAINING:
+                return
+            await asyncio.sleep(1)
+
 # ============================= Хендлеры =============================
 @router.message(CommandStart())
-async def start_cmd(msg: Message, state: FSMContext):
+async def start_cmd(msg: Message, state: FSMContext, uow: UnitOfWork):
     await state.clear()
-    async with get_conn() as conn:
-        lang = await conn.fetchval("SELECT lang FROM users WHERE user_id=$1", msg.from_user.id)
+    await uow.conn()  # язык не сбрасываем под нагрузкой: иначе перезапишем его догадкой
+    lang = await uow.stored_lang()
     if not lang:
-        guess = pick_default_lang(msg.from_user.language_code)
-        await set_lang(msg.from_user.id, guess)
+        guess = uow.tg_lang
+        await uow.set_lang(guess)
+        await uow.release()
         await msg.answer(T(guess, "start", btn_book=I18N[guess]["btn_book"]),
                          reply_markup=main_kb(guess, msg.from_user.id, msg.chat.id, msg.chat.type))
         await msg.answer(T(guess, "choose_lang"), reply_markup=lang_kb())
         await set_chat_public_commands(msg.bot, msg.from_user.id, guess)
         return
+    await uow.release()
     await msg.answer(T(lang, "start", btn_book=I18N[lang]["btn_book"]),
                      reply_markup=main_kb(lang, msg.from_user.id, msg.chat.id, msg.chat.type))
     await set_chat_public_commands(msg.bot, msg.from_user.id, lang)
 
 @router.message(F.text.in_(CHANGE_LANG_BTN_TEXTS))
 @router.message(Command("lang"))
-async def choose_lang_cmd(msg: Message):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def choose_lang_cmd(msg: Message, uow: UnitOfWork):
+    lang = await uow.lang()
     await msg.answer(T(lang, "choose_lang"), reply_markup=lang_kb())
 
 @router.callback_query(F.data.startswith("lang:"))
-async def set_lang_cb(cb: CallbackQuery):
+async def set_lang_cb(cb: CallbackQuery, uow: UnitOfWork):
     lang = cb.data.split(":")[1]
-    await set_lang(cb.from_user.id, lang)
+    lang = await uow.set_lang(lang)
+    await uow.release()
     await cb.message.edit_reply_markup()
     await cb.message.answer(T(lang, "lang_set"))
     await cb.message.answer(T(lang, "start", btn_book=I18N[lang]["btn_book"]),
@@ -632,13 +2526,13 @@ async def set_lang_cb(cb: CallbackQuery):
     await cb.answer()
 
 @router.message(Command("id"))
-async def get_id(msg: Message):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def get_id(msg: Message, uow: UnitOfWork):
+    lang = await uow.lang()
     await msg.answer(T(lang, "id", id=hbold(msg.chat.id)))
 
 @router.message(F.text.in_(MENU_BTN_TEXTS))
-async def show_menu(msg: Message):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def show_menu(msg: Message, uow: UnitOfWork):
+    lang = await uow.lang()
     if MENU_URL:
         await msg.answer(T(lang, "menu", url=MENU_URL))
     else:
@@ -646,21 +2540,68 @@ async def show_menu(msg: Message):
 
 @router.message(Command("book"))
 @router.message(F.text.in_(BOOK_BTN_TEXTS))
-async def book_start(msg: Message, state: FSMContext):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def book_start(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
     await state.clear()
-    await state.set_state(BookingForm.waiting_for_date)
-    await msg.answer(T(lang, "ask_date"), reply_markup=cancel_kb(lang))
+    # сначала число гостей: от него зависит доступность дней в календаре
+    await state.set_state(BookingForm.waiting_for_guests)
+    await msg.answer(T(lang, "ask_guests"), reply_markup=cancel_kb(lang))
 
 @router.message(F.text.in_(CANCEL_BTN_TEXTS))
-async def cancel(msg: Message, state: FSMContext):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def cancel(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
     await state.clear()
     await msg.answer(T(lang, "cancelled"), reply_markup=main_kb(lang, msg.from_user.id, msg.chat.id, msg.chat.type))
 
+@router.message(BookingForm.waiting_for_guests)
+async def step_guests(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
+    try:
+        guests = parse_guests_localized(msg.text, lang)
+    except ValueError as e:
+        await msg.answer(str(e)); return
+    await state.update_data(guests=guests)
+    today = _date.today()
+    month = await calendar_month(uow, today.year, today.month)
+    await uow.release()
+    await state.set_state(BookingForm.waiting_for_date)
+    await msg.answer(T(lang, "ask_date_pick", legend=T(lang, "cal_legend")),
+                     reply_markup=calendar_kb(lang, today.year, today.month, month, guests))
+
+@router.callback_query(StateFilter(BookingForm.waiting_for_date), F.data.startswith("cal:m:"))
+async def calendar_nav(cb: CallbackQuery, state: FSMContext, uow: UnitOfWork):
+    year, month = map(int, cb.data.split(":")[2].split("-"))
+    if not calendar_month_allowed(year, month):
+        return await cb.answer()
+    lang = await uow.lang()
+    data = await state.get_data()
+    month_data = await calendar_month(uow, year, month)
+    await uow.release()
+    await cb.message.edit_reply_markup(reply_markup=calendar_kb(lang, year, month, month_data, int(data["guests"])))
+    await cb.answer()
+
+@router.callback_query(StateFilter(BookingForm.waiting_for_date), F.data.startswith("cal:d:"))
+async def calendar_pick(cb: CallbackQuery, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
+    d = _date.fromisoformat(cb.data.split(":")[2])
+    if d < _date.today():
+        return await cb.answer(T(lang, "err_date_past"), show_alert=True)
+    await state.update_data(booking_date=d.isoformat())
+    await state.set_state(BookingForm.waiting_for_time)
+    await safe_edit_text(cb.message, T(lang, "date_picked", date=d.strftime("%d.%m.%Y")))
+    await cb.message.answer(T(lang, "ask_time"))
+    await cb.answer()
+
+@router.callback_query(F.data.startswith("cal:"))
+async def calendar_nop(cb: CallbackQuery, uow: UnitOfWork):
+    # заголовки, дни без мест и кнопки из устаревших календарей
+    if cb.data.startswith("cal:full"):
+        return await cb.answer(T(await uow.lang(), "no_tables"), show_alert=True)
+    await cb.answer()
+
 @router.message(BookingForm.waiting_for_date)
-async def step_date(msg: Message, state: FSMContext):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def step_date(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
     try:
         d = parse_date_localized(msg.text, lang)
     except ValueError as e:
@@ -669,58 +2610,54 @@ async def step_date(msg: Message, state: FSMContext):
     await state.set_state(BookingForm.waiting_for_time)
     await msg.answer(T(lang, "ask_time"))
 
+async def fetch_free_tables(conn: asyncpg.Connection, guests: int, day: _date, start: _time, end: _time) -> list:
+    return await conn.fetch(
+        """
+        SELECT t.id, t.title, t.seats
+        FROM tables t
+        WHERE t.is_active = TRUE
+          AND t.seats >= $1
+          AND t.id NOT IN (
+                SELECT b.table_id
+                FROM bookings b
+                WHERE b.booking_date = $2
+                  AND b.status IN ('new','confirmed','held')
+                  AND b.table_id IS NOT NULL
+                  AND (
+                        b.booking_time < $3::time
+                    AND (b.booking_time + (b.duration_min || ' minutes')::interval) > $4::time
+                  )
+          )
+        ORDER BY t.seats, t.title
+        """,
+        guests, day, end, start
+    )
+
 @router.message(BookingForm.waiting_for_time)
-async def step_time(msg: Message, state: FSMContext):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def step_time(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
     try:
         t = parse_time_localized(msg.text, lang)
     except ValueError as e:
         await msg.answer(str(e)); return
     await state.update_data(booking_time=t.strftime("%H:%M"))
-    await state.set_state(BookingForm.waiting_for_guests)
-    await msg.answer(T(lang, "ask_guests"))
-
-@router.message(BookingForm.waiting_for_guests)
-async def step_guests(msg: Message, state: FSMContext):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
-    try:
-        guests = parse_guests_localized(msg.text, lang)
-    except ValueError as e:
-        await msg.answer(str(e)); return
-    await state.update_data(guests=guests)
 
     data = await state.get_data()
+    guests = int(data["guests"])
     new_date = _date.fromisoformat(data["booking_date"])
-    new_start = _time.fromisoformat(data["booking_time"])
+    new_start = t
     new_start_dt = datetime.combine(new_date, new_start)
     new_end_dt = new_start_dt + timedelta(minutes=DURATION_MIN)
 
-    async with get_conn() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT t.id, t.title, t.seats
-            FROM tables t
-            WHERE t.is_active = TRUE
-              AND t.seats >= $1
-              AND t.id NOT IN (
-                    SELECT b.table_id
-                    FROM bookings b
-                    WHERE b.booking_date = $2
-                      AND b.status IN ('new','confirmed')
-                      AND b.table_id IS NOT NULL
-                      AND (
-                            b.booking_time < $3::time
-                        AND (b.booking_time + (b.duration_min || ' minutes')::interval) > $4::time
-                      )
-              )
-            ORDER BY t.seats, t.title
-            """,
-            int(guests), new_date, new_end_dt.time(), new_start
-        )
+    # окончательную проверку пересечений делает insert_bookings
+    rows = await uow.read(fetch_free_tables, guests, new_date, new_start, new_end_dt.time())
+    await uow.release()
 
     if not rows:
-        await msg.answer(T(lang, "no_tables"))
-        await state.set_state(BookingForm.waiting_for_time)
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=T(lang, "btn_waitlist_join"), callback_data="wl:join")
+        ]])
+        await msg.answer(T(lang, "no_tables"), reply_markup=kb)
         return
 
     kb = InlineKeyboardMarkup(
@@ -733,8 +2670,8 @@ async def step_guests(msg: Message, state: FSMContext):
     await msg.answer(T(lang, "ask_table"), reply_markup=kb)
 
 @router.callback_query(F.data.startswith("pick_table:"))
-async def pick_table(cb: CallbackQuery, state: FSMContext):
-    lang = await get_lang(cb.from_user.id, pick_default_lang(cb.from_user.language_code))
+async def pick_table(cb: CallbackQuery, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
     table_id = int(cb.data.split(":")[1])
     await state.update_data(table_id=table_id)
     await state.set_state(BookingForm.waiting_for_name)
@@ -743,8 +2680,8 @@ async def pick_table(cb: CallbackQuery, state: FSMContext):
     await cb.answer()
 
 @router.message(BookingForm.waiting_for_name)
-async def step_name(msg: Message, state: FSMContext):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def step_name(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
     name = msg.text.strip()
     if len(name) < 2:
         await msg.answer(T(lang, "err_name_short")); return
@@ -752,9 +2689,9 @@ async def step_name(msg: Message, state: FSMContext):
     await state.set_state(BookingForm.waiting_for_phone)
     await msg.answer(T(lang, "ask_phone"))
 
-@router.message(BookingForm.waiting_for_phone)
-async def step_phone(msg: Message, state: FSMContext):
-    lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+@router.message(BookingForm.waiting_for_phone, flags={"db_priority": PRIO_HIGH})
+async def step_phone(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
     phone = msg.text.strip()
     if len(phone) < 6:
         await msg.answer(T(lang, "err_phone_short")); return
@@ -762,27 +2699,38 @@ async def step_phone(msg: Message, state: FSMContext):
     data = await state.get_data()
     data.update({"phone": phone, "user_id": msg.from_user.id})
 
-    booking_date = _date.fromisoformat(data["booking_date"])
-    booking_time = _time.fromisoformat(data["booking_time"])
-    created_at   = datetime.now(UTC)
+    row = {
+        "user_id": data["user_id"], "name": data["name"], "phone": data["phone"],
+        "booking_date": _date.fromisoformat(data["booking_date"]),
+        "booking_time": _time.fromisoformat(data["booking_time"]),
+        "guests": int(data["guests"]),
+        "table_id": int(data.get("table_id") or 0),
+        "created_at": datetime.now(UTC),
+        "duration_min": DURATION_MIN,
+    }
+    if BOOKING_WRITER:
+        await uow.release()  # не держим соединение, пока ждём пачку
+        booking_id, lsn = await BOOKING_WRITER.submit(row)
+        if booking_id is not None:
+            await uow.mark_write(lsn=lsn)  # LSN коммита пачки — с соединения писателя
+    else:
+        async with uow.transaction() as conn:
+            booking_id = (await insert_bookings(conn, [row]))[0]
+        if booking_id is not None:
+            await uow.mark_write()
+        await uow.release()
+    if booking_id is None:
+        await state.set_state(BookingForm.waiting_for_time)
+        await msg.answer(T(lang, "err_table_taken"))
+        return
+    logger.info("Booking saved id=%s", booking_id)
+
+    await notify_admin_new_booking(msg.bot, lang, booking_id, data, msg.from_user.username or msg.from_user.id)
 
-    async with get_conn() as conn:
-        booking_id = await conn.fetchval(
-            """
-            INSERT INTO bookings
-              (user_id, name, phone, booking_date, booking_time, guests, table_id, created_at, status, duration_min)
-            VALUES ($1,$2,$3,$4,$5,$6,$7,$8,'new',$9)
-            RETURNING id
-            """,
-            data["user_id"], data["name"], data["phone"],
-            booking_date, booking_time, int(data["guests"]),
-            int(data.get("table_id") or 0),
-            created_at,
-            DURATION_MIN
-        )
-        logger.info("Booking saved id=%s", booking_id)
+    await state.clear()
+    await msg.answer(T(lang, "thanks"), reply_markup=main_kb(lang, msg.from_user.id, msg.chat.id, msg.chat.type))
 
-    user_lang = await get_lang(msg.from_user.id, pick_default_lang(msg.from_user.language_code))
+async def notify_admin_new_booking(bot: Bot, user_lang: str, booking_id: int, data: dict, who):
     admin_text = (
         f"{T(user_lang, 'admin_new')}\n"
         f"{T(user_lang, 'admin_field_date')}: {data['booking_date']}\n"
@@ -791,7 +2739,7 @@ async def step_phone(msg: Message, state: FSMContext):
         f"{T(user_lang, 'admin_field_guests')}: {data['guests']}\n"
         f"{T(user_lang, 'admin_field_name')}: {data['name']}\n"
         f"{T(user_lang, 'admin_field_phone')}: {data['phone']}\n"
-        f"{T(user_lang, 'admin_field_user')}: @{msg.from_user.username or msg.from_user.id}"
+        f"{T(user_lang, 'admin_field_user')}: @{who}"
     )
     kb = InlineKeyboardMarkup(
         inline_keyboard=[[
@@ -802,12 +2750,268 @@ async def step_phone(msg: Message, state: FSMContext):
     )
     try:
         if ADMIN_CHAT_ID:
-            await msg.bot.send_message(ADMIN_CHAT_ID, admin_text, reply_markup=kb)
+            await bot.send_message(ADMIN_CHAT_ID, admin_text, reply_markup=kb)
     except Exception as e:
         logger.exception("Не удалось отправить уведомление администратору: %s", e)
 
+# ===== Лист ожидания =====
+# Когда на выбранное время столиков нет, гость может встать в лист ожидания на
+# (дату, окно времени, число гостей). Отмена или удаление брони шлёт NOTIFY
+# slot_freed; лидер берёт свободный промежуток на этом столике, находит по
+# индексу самую большую подходящую компанию (при равенстве — с более ранним
+# окном, затем первую записавшуюся), ставит бронь в статус 'held' и предлагает
+# её гостю. Не ответил за WAITLIST_HOLD_S или отказался — бронь удаляется, и
+# тот же NOTIFY предлагает столик следующему.
+WAITLIST_HOLD_S  = int(os.getenv("WAITLIST_HOLD_S", "600"))
+WAITLIST_WINDOWS = {"30": 30, "60": 60, "day": None}  # ± минут от желаемого времени
+
+WAITLIST_MATCH = """
+SELECT id, user_id, lang, name, phone, guests, pref_time, time_from, time_to
+FROM waitlist
+WHERE tsrange(booking_date + time_from, booking_date + time_to, '[]') && tsrange($1::date + $3::time, $1::date + $4::time, '[]')
+  AND booking_date = $1 AND status = 'waiting' AND guests <= $2
+ORDER BY guests DESC, time_from, id
+LIMIT 1
+FOR UPDATE SKIP LOCKED
+"""
+
+INSERT_HELD_BOOKING = """
+WITH ins AS (
+    INSERT INTO bookings (user_id, name, phone, booking_date, booking_time, guests, table_id, status, duration_min)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, 'held', $8)
+    RETURNING *
+), ev AS (
+    INSERT INTO booking_events(booking_id, kind, booking) SELECT id, 'created', to_jsonb(ins) FROM ins
+)
+SELECT id FROM ins
+"""
+
+def _from_minutes(m: int) -> _time:
+    return _time(m // 60, m % 60)
+
+# Допустимые времена начала (lo, hi) в свободном промежутке вокруг freed_min или None
+def free_start_range(busy: list[tuple[int, int]], freed_min: int, day: _date) -> tuple[int, int] | None:
+    if any(s <= freed_min < e for s, e in busy):
+        return None  # место уже заняли
+    gap_start = max((e for s, e in busy if e <= freed_min), default=0)
+    gap_end = min((s for s, e in busy if s > freed_min), default=24 * 60 + DURATION_MIN)
+    lo = max(gap_start, _minutes(OPEN_TIME))
+    if day == _date.today():
+        now = datetime.now()
+        lo = max(lo, -(-(now.hour * 60 + now.minute) // 15) * 15)  # не раньше ближайших 15 минут
+    hi = min(gap_end - DURATION_MIN, _minutes(CLOSE_TIME))
+    return (lo, hi) if lo <= hi else None
+
+def on_slot_freed(conn, pid, channel, payload: str):
+    if DRAINING:
+        return
+    try:
+        data = json.loads(payload)
+        day, freed, table_id = _date.fromisoformat(data["date"]), _time.fromisoformat(data["time"]), int(data["table_id"])
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Bad slot_freed payload: %r", payload)
+        return
+    if day >= _date.today():
+        spawn(offer_slot(day, table_id, freed))
+
+async def offer_slot(day: _date, table_id: int, freed: _time):
+    try:
+        async with get_conn(PRIO_NORMAL) as conn:
+            async with conn.transaction():
+                # та же блокировка, что в insert_bookings: параллельная бронь на столик подождёт
+                seats = await conn.fetchval(
+                    "SELECT seats FROM tables WHERE id=$1 AND is_active = TRUE FOR UPDATE", table_id
+                )
+                if seats is None:
+                    return
+                busy = [
+                    (_minutes(r["booking_time"]), _minutes(r["booking_time"]) + r["duration_min"])
+                    for r in await conn.fetch(
+                        "SELECT booking_time, duration_min FROM bookings "
+                        "WHERE table_id=$1 AND booking_date=$2 AND status IN ('new','confirmed','held')",
+                        table_id, day
+                    )
+                ]
+                window = free_start_range(busy, _minutes(freed), day)
+                if window is None:
+                    return
+                lo, hi = window
+                party = await conn.fetchrow(WAITLIST_MATCH, day, seats, _from_minutes(lo), _from_minutes(hi))
+                if party is None:
+                    return
+                lo, hi = max(lo, _minutes(party["time_from"])), min(hi, _minutes(party["time_to"]))
+                start = _from_minutes(min(max(_minutes(party["pref_time"]), lo), hi))
+                booking_id = await conn.fetchval(
+                    INSERT_HELD_BOOKING, party["user_id"], party["name"], party["phone"], day, start,
+                    party["guests"], table_id, DURATION_MIN
+                )
+                await conn.execute(
+                    "UPDATE waitlist SET status='offered', booking_id=$2, "
+                    "hold_until=now() + make_interval(secs => $3) WHERE id=$1",
+                    party["id"], booking_id, WAITLIST_HOLD_S
+                )
+            await note_write(party["user_id"], conn=conn)
+    except (DbOverloaded, *CONN_LOST_ERRORS) as e:
+        logger.warning("Waitlist offer for table %s on %s skipped: %r", table_id, day, e)
+        return
+    logger.info("Waitlist #%s offered table %s on %s %s", party["id"], table_id, day, start)
+
+    lang = party["lang"]
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=T(lang, "btn_wl_accept"), callback_data=f"wl:acc:{party['id']}"),
+        InlineKeyboardButton(text=T(lang, "btn_wl_decline"), callback_data=f"wl:dec:{party['id']}"),
+    ]])
+    try:
+        await bot.send_message(
+            party["user_id"],
+            T(lang, "wl_offer", date=f"{day:%d.%m.%Y}", time=f"{start:%H:%M}", guests=party["guests"],
+              minutes=WAITLIST_HOLD_S // 60),
+            reply_markup=kb
+        )
+    except Exception as e:  # гость заблокировал бота и т.п. — сразу предлагаем следующему
+        logger.warning("Cannot send waitlist offer #%s: %s", party["id"], e)
+        async with get_conn(PRIO_NORMAL) as conn:
+            await release_offer(conn, party["id"], "declined")
+
+# Снимает предложение: бронь 'held' удаляется, её NOTIFY запускает подбор следующего гостя
+async def release_offer(conn: asyncpg.Connection, waitlist_id: int, status: str, user_id: int | None = None) -> bool:
+    async with conn.transaction():
+        booking_id = await conn.fetchval(
+            "UPDATE waitlist SET status=$2 WHERE id=$1 AND status='offered' "
+            "AND ($3::bigint IS NULL OR user_id=$3) RETURNING booking_id",
+            waitlist_id, status, user_id
+        )
+        if booking_id is None:
+            return False
+        await delete_booking(conn, booking_id)
+    return True
+
+async def expire_waitlist_offers():
+    while not DRAINING:
+        try:
+            async with get_conn(PRIO_LOW) as conn:
+                expired = await conn.fetch(
+                    "SELECT id, user_id, lang FROM waitlist WHERE status='offered' AND hold_until < now()"
+                )
+                await conn.execute(
+                    "UPDATE waitlist SET status='expired' WHERE status='waiting' AND booking_date < CURRENT_DATE"
+                )
+                released = [r for r in expired if await release_offer(conn, r["id"], "expired")]
+            for r in released:
+                try:
+                    await bot.send_message(r["user_id"], T(r["lang"], "wl_expired"))
+                except Exception:
+                    pass
+        except DbOverloaded:
+            pass
+        except Exception:
+            logger.exception("Waitlist expiry failed")
+        for _ in range(15):
+            if DRAINING:
+                return
+            await asyncio.sleep(1)
+
+@router.callback_query(StateFilter(BookingForm.waiting_for_time), F.data == "wl:join")
+async def wl_join(cb: CallbackQuery, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
+    await uow.release()
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=T(lang, f"btn_wl_win_{key}"), callback_data=f"wl:win:{key}")
+        for key in WAITLIST_WINDOWS
+    ]])
+    await state.set_state(WaitlistForm.waiting_for_window)
+    await cb.message.edit_reply_markup()
+    await cb.message.answer(T(lang, "wl_ask_window"), reply_markup=kb)
+    await cb.answer()
+
+@router.callback_query(StateFilter(WaitlistForm.waiting_for_window), F.data.startswith("wl:win:"))
+async def wl_window(cb: CallbackQuery, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
+    await uow.release()
+    key = cb.data.split(":")[2]
+    if key not in WAITLIST_WINDOWS:
+        return await cb.answer()
+    data = await state.get_data()
+    pref = _minutes(_time.fromisoformat(data["booking_time"]))
+    delta = WAITLIST_WINDOWS[key]
+    open_m, close_m = _minutes(OPEN_TIME), _minutes(CLOSE_TIME)
+    lo, hi = (open_m, close_m) if delta is None else (max(pref - delta, open_m), min(pref + delta, close_m))
+    await state.update_data(time_from=_from_minutes(lo).strftime("%H:%M"), time_to=_from_minutes(hi).strftime("%H:%M"))
+    await state.set_state(WaitlistForm.waiting_for_name)
+    await cb.message.edit_reply_markup()
+    await cb.message.answer(T(lang, "ask_name"))
+    await cb.answer()
+
+@router.message(WaitlistForm.waiting_for_name)
+async def wl_name(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
+    name = msg.text.strip()
+    if len(name) < 2:
+        await msg.answer(T(lang, "err_name_short")); return
+    await state.update_data(name=name)
+    await state.set_state(WaitlistForm.waiting_for_phone)
+    await msg.answer(T(lang, "ask_phone"))
+
+@router.message(WaitlistForm.waiting_for_phone)
+async def wl_phone(msg: Message, state: FSMContext, uow: UnitOfWork):
+    lang = await uow.lang()
+    phone = msg.text.strip()
+    if len(phone) < 6:
+        await msg.answer(T(lang, "err_phone_short")); return
+    data = await state.get_data()
+    conn = await uow.conn()
+    await conn.execute(
+        "INSERT INTO waitlist(user_id, lang, name, phone, booking_date, pref_time, time_from, time_to, guests) "
+        "VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9)",
+        msg.from_user.id, lang, data["name"], phone, _date.fromisoformat(data["booking_date"]),
+        _time.fromisoformat(data["booking_time"]), _time.fromisoformat(data["time_from"]),
+        _time.fromisoformat(data["time_to"]), int(data["guests"])
+    )
+    await uow.release()
     await state.clear()
-    await msg.answer(T(lang, "thanks"), reply_markup=main_kb(lang, msg.from_user.id, msg.chat.id, msg.chat.type))
+    await msg.answer(
+        T(lang, "wl_joined", date=_date.fromisoformat(data["booking_date"]).strftime("%d.%m.%Y"),
+          time_from=data["time_from"], time_to=data["time_to"], guests=data["guests"]),
+        reply_markup=main_kb(lang, msg.from_user.id, msg.chat.id, msg.chat.type)
+    )
+
+@router.callback_query(F.data.startswith("wl:acc:"), flags={"db_priority": PRIO_HIGH})
+async def wl_accept(cb: CallbackQuery, uow: UnitOfWork):
+    lang = await uow.lang()
+    waitlist_id = int(cb.data.split(":")[2])
+    async with uow.transaction() as conn:
+        booking_id = await conn.fetchval(
+            "UPDATE waitlist SET status='booked' WHERE id=$1 AND user_id=$2 "
+            "AND status='offered' AND hold_until > now() RETURNING booking_id",
+            waitlist_id, cb.from_user.id
+        )
+        if booking_id is not None:
+            await set_status(conn, booking_id, "new")
+            booking = await conn.fetchrow("SELECT * FROM bookings WHERE id=$1", booking_id)
+    if booking_id is not None:
+        await uow.mark_write()
+    await uow.release()
+    await cb.message.edit_reply_markup()
+    if booking_id is None:
+        await cb.message.answer(T(lang, "wl_expired"))
+        return await cb.answer()
+    day, start = booking["booking_date"], booking["booking_time"]
+    await cb.message.answer(T(lang, "wl_accepted", date=f"{day:%d.%m.%Y}", time=f"{start:%H:%M}"))
+    await cb.answer()
+    data = dict(booking, booking_date=day.isoformat(), booking_time=start.strftime("%H:%M"))
+    await notify_admin_new_booking(cb.bot, lang, booking_id, data, cb.from_user.username or cb.from_user.id)
+
+@router.callback_query(F.data.startswith("wl:dec:"))
+async def wl_decline(cb: CallbackQuery, uow: UnitOfWork):
+    lang = await uow.lang()
+    declined = await release_offer(await uow.conn(), int(cb.data.split(":")[2]), "declined", cb.from_user.id)
+    if declined:
+        await uow.mark_write()
+    await uow.release()
+    if declined:
+        await cb.message.answer(T(lang, "wl_declined"))
+    await cb.message.edit_reply_markup()
+    await cb.answer()
 
 # ===== Удаление по ID =====
 @router.callback_query(F.data.startswith("ap:delask:"))
@@ -819,7 +3023,7 @@ async def ap_delask(cb: CallbackQuery, state: FSMContext):
     await cb.answer()
 
 @router.message(Command("del"))
-async def del_cmd(msg: Message, state: FSMContext):
+async def del_cmd(msg: Message, state: FSMContext, uow: UnitOfWork):
     if not can_admin(msg.from_user.id, msg.chat.id, msg.chat.type):
         return
     parts = (msg.text or "").split()
@@ -830,19 +3034,21 @@ async def del_cmd(msg: Message, state: FSMContext):
     if not bid_str.isdigit():
         return await msg.answer("ID должен быть числом. Пример: /del 12")
     bid = int(bid_str)
-    async with get_conn() as conn:
-        row = await conn.fetchrow("DELETE FROM bookings WHERE id=$1 RETURNING id", bid)
-    await msg.answer(f"Бронь #{bid} удалена." if row else f"Бронь #{bid} не найдена.")
+    deleted = await delete_booking(await uow.conn(), bid)
+    await uow.mark_write()
+    await uow.release()
+    await msg.answer(f"Бронь #{bid} удалена." if deleted else f"Бронь #{bid} не найдена.")
 
 @router.message(StateFilter(AdminDelete.waiting_for_id), F.text.regexp(r"^\s*#?\d+\s*$"), flags={"block": True})
-async def ap_delete_by_id_input(msg: Message, state: FSMContext):
+async def ap_delete_by_id_input(msg: Message, state: FSMContext, uow: UnitOfWork):
     if not can_admin(msg.from_user.id, msg.chat.id, msg.chat.type):
         return
     bid = int((msg.text or "").strip().lstrip("#"))
-    async with get_conn() as conn:
-        row = await conn.fetchrow("DELETE FROM bookings WHERE id=$1 RETURNING id", bid)
+    deleted = await delete_booking(await uow.conn(), bid)
+    await uow.mark_write()
+    await uow.release()
     await state.clear()
-    await msg.answer(f"Бронь #{bid} удалена." if row else f"Бронь #{bid} не найдена.")
+    await msg.answer(f"Бронь #{bid} удалена." if deleted else f"Бронь #{bid} не найдена.")
 
 @router.message(StateFilter(AdminDelete.waiting_for_id), flags={"block": True})
 async def ap_delete_by_id_wrong(msg: Message):
@@ -851,13 +3057,15 @@ async def ap_delete_by_id_wrong(msg: Message):
     await msg.answer("Нужно число. Пример: 12")
 
 # ===== Коллбеки админа из уведомлений =====
-@router.callback_query(F.data.startswith("adm:confirm:"))
-async def admin_confirm(cb: CallbackQuery):
+@router.callback_query(F.data.startswith("adm:confirm:"), flags={"db_priority": PRIO_HIGH})
+async def admin_confirm(cb: CallbackQuery, uow: UnitOfWork):
     booking_id = int(cb.data.split(":")[2])
-    bid, user_id = await set_status(booking_id, "confirmed")
+    bid, user_id = await set_status(await uow.conn(), booking_id, "confirmed")
+    await uow.mark_write(user_id)
     if not bid:
         return await cb.answer("Бронь не найдена", show_alert=True)
-    user_lang = await get_lang(user_id, "ru")
+    user_lang = await uow.lang_of(user_id, "ru")
+    await uow.release()
     await cb.message.edit_text(cb.message.text + f"\n\n{T(user_lang, 'admin_note_confirmed')}")
     try:
         await cb.bot.send_message(user_id, T(user_lang, "user_confirmed"))
@@ -865,13 +3073,15 @@ async def admin_confirm(cb: CallbackQuery):
         pass
     await cb.answer("OK")
 
-@router.callback_query(F.data.startswith("adm:cancel:"))
-async def admin_cancel(cb: CallbackQuery):
+@router.callback_query(F.data.startswith("adm:cancel:"), flags={"db_priority": PRIO_HIGH})
+async def admin_cancel(cb: CallbackQuery, uow: UnitOfWork):
     booking_id = int(cb.data.split(":")[2])
-    bid, user_id = await set_status(booking_id, "cancelled")
+    bid, user_id = await set_status(await uow.conn(), booking_id, "cancelled")
+    await uow.mark_write(user_id)
     if not bid:
         return await cb.answer("Бронь не найдена", show_alert=True)
-    user_lang = await get_lang(user_id, "ru")
+    user_lang = await uow.lang_of(user_id, "ru")
+    await uow.release()
     await cb.message.edit_text(cb.message.text + f"\n\n{T(user_lang, 'admin_note_cancelled')}")
     try:
         await cb.bot.send_message(user_id, T(user_lang, "user_cancelled"))
@@ -880,13 +3090,14 @@ async def admin_cancel(cb: CallbackQuery):
     await cb.answer("OK")
 
 # ===== Мини-панель админа (/admin) =====
+# Имя и телефон вводит гость — экранируем, сообщения уходят с parse_mode=HTML
 def fmt_admin_booking_line(row, lang: str) -> str:
     return (f"#{row['id']} — {row['booking_date']} {row['booking_time']}, "
             f"{T(lang,'admin_field_table').lower()}:{row['table_id'] or '—'}, "
             f"{T(lang,'admin_field_guests').lower()}:{row['guests']}, "
-            f"{row['name']} ({row['phone']}) [{row['status']}]")
+            f"{html.escape(row['name'])} ({html.escape(row['phone'])}) [{row['status']}]")
 
-async def fetch_bookings(page: int = 0, status: str = "all"):
+async def fetch_bookings(conn: asyncpg.Connection, page: int = 0, status: str = "all"):
     offset = page * PAGE_SIZE
     where = "" if status == "all" else "WHERE status = $1"
     params = [] if status == "all" else [status]
@@ -898,9 +3109,7 @@ async def fetch_bookings(page: int = 0, status: str = "all"):
         ORDER BY booking_date DESC, booking_time DESC, id DESC
         LIMIT {PAGE_SIZE} OFFSET {offset}
     """
-    async with get_conn() as conn:
-        rows = await conn.fetch(query, *params)
-    return rows
+    return await conn.fetch(query, *params)
 
 def admin_list_kb(page: int, status: str, lang: str = "ru") -> InlineKeyboardMarkup:
     status_disp = {
@@ -928,14 +3137,14 @@ def admin_list_kb(page: int, status: str, lang: str = "ru") -> InlineKeyboardMar
 async def ap_nop(cb: CallbackQuery):
     await cb.answer()
 
-@router.message(F.text == I18N["ru"]["btn_admin_panel"])
-@router.message(F.text == I18N["lv"]["btn_admin_panel"])
-@router.message(F.text == I18N["en"]["btn_admin_panel"])
-@router.message(Command("admin"))
-async def admin_panel(msg: Message):
+@router.message(F.text == I18N["ru"]["btn_admin_panel"], flags={"db_priority": PRIO_LOW})
+@router.message(F.text == I18N["lv"]["btn_admin_panel"], flags={"db_priority": PRIO_LOW})
+@router.message(F.text == I18N["en"]["btn_admin_panel"], flags={"db_priority": PRIO_LOW})
+@router.message(Command("admin"), flags={"db_priority": PRIO_LOW})
+async def admin_panel(msg: Message, uow: UnitOfWork):
     if not can_admin(msg.from_user.id, msg.chat.id, msg.chat.type):
         return
-    lang = await get_lang(msg.from_user.id, "ru")
+    lang = await uow.lang("ru")
     status = "all"
     status_disp = {
         "all": I18N[lang]["admin_filter_all"],
@@ -943,14 +3152,15 @@ async def admin_panel(msg: Message):
         "confirmed": I18N[lang]["admin_filter_confirmed"],
         "cancelled": I18N[lang]["admin_filter_cancelled"],
     }[status]
-    rows = await fetch_bookings(page=0, status=status)
+    rows = await uow.read(fetch_bookings, 0, status)
+    await uow.release()
     header = T(lang, "admin_list_header", page=1, status_label=I18N[lang]["admin_status_label"], status=status_disp)
     text = header + "\n\n" + ("\n".join([fmt_admin_booking_line(r, lang) for r in rows]) if rows else T(lang,"empty"))
     await safe_send_text(msg.bot, msg.chat.id, text, reply_markup=admin_list_kb(0, status, lang))
     await msg.answer("🤗", reply_markup=main_kb(lang, msg.from_user.id, msg.chat.id, msg.chat.type))
 
 @router.message(AdminDelete.waiting_for_id)
-async def ap_delete_waiting(msg: Message, state: FSMContext):
+async def ap_delete_waiting(msg: Message, state: FSMContext, uow: UnitOfWork):
     if not can_admin(msg.from_user.id, msg.chat.id, msg.chat.type):
         return
     txt = (msg.text or "").strip()
@@ -960,69 +3170,76 @@ async def ap_delete_waiting(msg: Message, state: FSMContext):
     if not bid_str.isdigit():
         return await msg.answer("Нужно число. Пример: 12")
     bid = int(bid_str)
-    async with get_conn() as conn:
-        row = await conn.fetchrow("DELETE FROM bookings WHERE id=$1 RETURNING id", bid)
+    deleted = await delete_booking(await uow.conn(), bid)
+    await uow.mark_write()
+    await uow.release()
     await state.clear()
-    await msg.answer(f"Бронь #{bid} удалена." if row else f"Бронь #{bid} не найдена.")
+    await msg.answer(f"Бронь #{bid} удалена." if deleted else f"Бронь #{bid} не найдена.")
 
-@router.callback_query(F.data.startswith("ap:page:"))
-async def ap_page(cb: CallbackQuery):
+@router.callback_query(F.data.startswith("ap:page:"), flags={"db_priority": PRIO_LOW})
+async def ap_page(cb: CallbackQuery, uow: UnitOfWork):
     if not can_admin(cb.from_user.id, cb.message.chat.id, cb.message.chat.type):
         return await cb.answer()
     _, _, page_str, status = cb.data.split(":")
     page = max(int(page_str), 0)
-    lang = await get_lang(cb.from_user.id, "ru")
+    lang = await uow.lang("ru")
     status_disp = {
         "all": I18N[lang]["admin_filter_all"],
         "new": I18N[lang]["admin_filter_new"],
         "confirmed": I18N[lang]["admin_filter_confirmed"],
         "cancelled": I18N[lang]["admin_filter_cancelled"],
     }.get(status, status)
-    rows = await fetch_bookings(page=page, status=status)
+    rows = await uow.read(fetch_bookings, page, status)
+    await uow.release()
     header = T(lang, "admin_list_header", page=page+1, status_label=I18N[lang]["admin_status_label"], status=status_disp)
     text = header + "\n\n" + ("\n".join([fmt_admin_booking_line(r, lang) for r in rows]) if rows else T(lang, "empty"))
     await safe_edit_text(cb.message, text, reply_markup=admin_list_kb(page, status, lang))
     await cb.answer()
 
-@router.callback_query(F.data.startswith("ap:set_status:"))
-async def ap_set_status(cb: CallbackQuery):
+@router.callback_query(F.data.startswith("ap:set_status:"), flags={"db_priority": PRIO_LOW})
+async def ap_set_status(cb: CallbackQuery, uow: UnitOfWork):
     if not can_admin(cb.from_user.id, cb.message.chat.id, cb.message.chat.type):
         return await cb.answer()
     _, _, page_str, status = cb.data.split(":")
     page = max(int(page_str), 0)
-    lang = await get_lang(cb.from_user.id, "ru")
+    lang = await uow.lang("ru")
     status_disp = {
         "all": I18N[lang]["admin_filter_all"],
         "new": I18N[lang]["admin_filter_new"],
         "confirmed": I18N[lang]["admin_filter_confirmed"],
         "cancelled": I18N[lang]["admin_filter_cancelled"],
     }.get(status, status)
-    rows = await fetch_bookings(page=page, status=status)
+    rows = await uow.read(fetch_bookings, page, status)
+    await uow.release()
     header = T(lang, "admin_list_header", page=page+1, status_label=I18N[lang]["admin_status_label"], status=status_disp)
     text = header + "\n\n" + ("\n".join([fmt_admin_booking_line(r, lang) for r in rows]) if rows else T(lang, "empty"))
     await safe_edit_text(cb.message, text, reply_markup=admin_list_kb(page, status, lang))
     await cb.answer(I18N[lang]["admin_status_label"] + " ✓")
 
-@router.callback_query(F.data.startswith("ap:confirm:"))
-async def ap_confirm(cb: CallbackQuery):
+@router.callback_query(F.data.startswith("ap:confirm:"), flags={"db_priority": PRIO_HIGH})
+async def ap_confirm(cb: CallbackQuery, uow: UnitOfWork):
     if not can_admin(cb.from_user.id, cb.message.chat.id, cb.message.chat.type):
         return await cb.answer()
     bid = int(cb.data.split(":")[2])
-    _, user_id = await set_status(bid, "confirmed")
-    lang = await get_lang(user_id, "ru")
+    _, user_id = await set_status(await uow.conn(), bid, "confirmed")
+    await uow.mark_write(user_id)
+    lang = await uow.lang_of(user_id, "ru")
+    await uow.release()
     try:
         await cb.bot.send_message(user_id, T(lang, "user_confirmed"))
     except Exception:
         pass
     await cb.answer("Подтверждено")
 
-@router.callback_query(F.data.startswith("ap:cancel:"))
-async def ap_cancel(cb: CallbackQuery):
+@router.callback_query(F.data.startswith("ap:cancel:"), flags={"db_priority": PRIO_HIGH})
+async def ap_cancel(cb: CallbackQuery, uow: UnitOfWork):
     if not can_admin(cb.from_user.id, cb.message.chat.id, cb.message.chat.type):
         return await cb.answer()
     bid = int(cb.data.split(":")[2])
-    _, user_id = await set_status(bid, "cancelled")
-    lang = await get_lang(user_id, "ru")
+    _, user_id = await set_status(await uow.conn(), bid, "cancelled")
+    await uow.mark_write(user_id)
+    lang = await uow.lang_of(user_id, "ru")
+    await uow.release()
     try:
         await cb.bot.send_message(user_id, T(lang, "user_cancelled"))
     except Exception:
@@ -1030,14 +3247,381 @@ async def ap_cancel(cb: CallbackQuery):
     await cb.answer("Отменено")
 
 @router.callback_query(F.data.startswith("ap:delete:"))
-async def ap_delete(cb: CallbackQuery):
+async def ap_delete(cb: CallbackQuery, uow: UnitOfWork):
     if not can_admin(cb.from_user.id, cb.message.chat.id, cb.message.chat.type):
         return await cb.answer()
     bid = int(cb.data.split(":")[2])
-    async with get_conn() as conn:
-        await conn.execute("DELETE FROM bookings WHERE id=$1", bid)
+    await delete_booking(await uow.conn(), bid)
+    await uow.mark_write()
+    await uow.release()
     await cb.answer("Удалено")
 
+@router.message(Command("profile"))
+async def profile_cmd(msg: Message):
+    if not can_admin(msg.from_user.id, msg.chat.id, msg.chat.type):
+        return
+    parts = (msg.text or "").split()
+    seconds = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 30
+    seconds = min(max(seconds, 1), PROFILE_MAX_S)
+    if _profiling:
+        return await msg.answer("Профилирование уже идёт.")
+    spawn(run_profile(msg.bot, msg.chat.id, seconds))
+    await msg.answer(f"Профилирую {seconds} с, пришлю файл со стеками.")
+
+# ===== Рассылка (/broadcast) =====
+# /broadcast <текст> — сообщение всем из users. Версии на разных языках задаются
+# блоками "ru: ...", "lv: ...", "en: ..."; каждый получает версию на своём языке
+# (если её нет — текст без метки или первую версию). После предпросмотра и
+# подтверждения задание уходит в broadcasts, а шлёт его только лидер: идёт по
+# users keyset-пачками (user_id > last_user_id) и каждые BROADCAST_CHECKPOINT
+# получателей сохраняет курсор и счётчики. После редеплоя новый лидер продолжает
+# с курсора, так что повторно сообщение получат не больше BROADCAST_CHECKPOINT
+# человек. Темп — BROADCAST_RATE сообщений в секунду; на 429 ждём retry_after и
+# вдвое снижаем темп, потом он плавно возвращается. Заблокировавшие бота
+# получают users.blocked_at и в следующие рассылки не попадают.
+BROADCAST_RATE       = float(os.getenv("BROADCAST_RATE", "25"))  # общий лимит Telegram ~30/с
+BROADCAST_BATCH      = 500
+BROADCAST_CHECKPOINT = 50
+BROADCAST_REPORT_S   = 15
+BROADCAST_LOCK_NS    = 0x0B0D  # advisory lock задания: не даём двум деплоям слать одно и то же
+
+_broadcast_wake = asyncio.Event()
+
+def parse_broadcast_texts(text: str) -> dict[str, str]:
+    blocks: dict[str | None, list[str]] = {}
+    current: str | None = None
+    for line in text.splitlines():
+        m = re.match(r"\s*(ru|lv|en)\s*:\s?(.*)$", line)
+        if m:
+            current = m[1]
+            line = m[2]
+        blocks.setdefault(current, []).append(line)
+    texts = {k: "\n".join(v).strip() for k, v in blocks.items()}
+    texts = {k: v for k, v in texts.items() if v}
+    fallback = texts.get(None) or next(iter(texts.values()), "")
+    return {lang: texts.get(lang) or fallback for lang in LANGS}
+
+async def fetch_broadcast_batch(conn: asyncpg.Connection, after_user_id: int) -> list:
+    return await conn.fetch(
+        "SELECT user_id, lang FROM users WHERE user_id > $1 AND blocked_at IS NULL ORDER BY user_id LIMIT $2",
+        after_user_id, BROADCAST_BATCH
+    )
+
+class BroadcastRun:
+    def __init__(self, bot: Bot, job):
+        self.bot, self.job_id, self.chat_id = bot, job["id"], job["chat_id"]
+        self.texts: dict[str, str] = json.loads(job["texts"])
+        self.total = job["total"]
+        self.cursor = job["last_user_id"]
+        self.sent, self.failed, self.blocked = job["sent"], job["failed"], job["blocked"]
+        self.report_message_id = job["report_message_id"]
+        self.rate = BROADCAST_RATE
+        self._started = time.monotonic()
+        self._done_at_start = self.done
+        self._new_blocked: list[int] = []
+        self._next_send = 0.0
+        self._last_report = 0.0
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def throughput(self) -> float:
+        return (self.done - self._done_at_start) / max(time.monotonic() - self._started, 1e-3)
+
+    async def run(self) -> str:
+        await self.report()
+        status = "running"
+        while status == "running" and not DRAINING:
+            batch = await read_with_retry(fetch_broadcast_batch, self.cursor)
+            if not batch:
+                status = "done"
+                break
+            since_checkpoint = 0
+            for r in batch:
+                if DRAINING:
+                    break
+                result = await self.send(r["user_id"], self.texts.get(r["lang"]) or self.texts["ru"])
+                setattr(self, result, getattr(self, result) + 1)
+                if result == "blocked":
+                    self._new_blocked.append(r["user_id"])
+                self.cursor = r["user_id"]
+                since_checkpoint += 1
+                if since_checkpoint >= BROADCAST_CHECKPOINT:
+                    since_checkpoint = 0
+                    status = await self.checkpoint()
+                    if status != "running":
+                        break
+                    if time.monotonic() - self._last_report >= BROADCAST_REPORT_S:
+                        await self.report()
+            if status == "running":
+                status = await self.checkpoint()
+        await self.checkpoint("done" if status == "done" else None)
+        await self.report(final=status)
+        return status
+
+    async def send(self, user_id: int, text: str) -> str:
+        for _ in range(3):
+            delay = self._next_send - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_send = max(self._next_send, time.monotonic()) + 1 / self.rate
+            try:
+                await self.bot.send_message(user_id, text)
+            except TelegramRetryAfter as e:
+                self.rate = max(1.0, self.rate / 2)
+                logger.warning("Broadcast #%s hit 429, waiting %ss, rate now %.1f/s", self.job_id, e.retry_after, self.rate)
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                return "blocked" if "chat not found" in str(e).lower() else "failed"
+            except Exception as e:
+                logger.warning("Broadcast #%s to %s failed: %r", self.job_id, user_id, e)
+                return "failed"
+            self.rate = min(BROADCAST_RATE, self.rate + 0.05)
+            return "sent"
+        return "failed"
+
+    # Курсор, счётчики и отметки блокировок — одной транзакцией; возвращает статус задания
+    async def checkpoint(self, status: str | None = None) -> str:
+        async with get_conn(PRIO_HIGH) as conn:
+            async with conn.transaction():
+                if self._new_blocked:
+                    await conn.execute(
+                        "UPDATE users SET blocked_at = now() WHERE user_id = ANY($1::bigint[])", self._new_blocked
+                    )
+                current = await conn.fetchval(
+                    """
+                    UPDATE broadcasts
+                    SET last_user_id=$2, sent=$3, failed=$4, blocked=$5, report_message_id=$6,
+                        status=CASE WHEN $7::text IS NOT NULL AND status='running' THEN $7 ELSE status END,
+                        finished_at=CASE WHEN $7::text IS NOT NULL THEN now() ELSE finished_at END
+                    WHERE id=$1
+                    RETURNING status
+                    """,
+                    self.job_id, self.cursor, self.sent, self.failed, self.blocked, self.report_message_id, status
+                )
+        self._new_blocked.clear()
+        return current
+
+    async def report(self, final: str | None = None):
+        self._last_report = time.monotonic()
+        title = {
+            None: "📣 Рассылка #{id} идёт",
+            "running": "⏸ Рассылка #{id} приостановлена (редеплой), продолжится автоматически",
+            "done": "✅ Рассылка #{id} завершена",
+            "cancelled": "⛔ Рассылка #{id} остановлена",
+        }[final].format(id=self.job_id)
+        text = (
+            f"{title}\n"
+            f"Обработано: {self.done}/{max(self.total, self.done)}\n"
+            f"Отправлено: {self.sent} · ошибки: {self.failed} · заблокировали бота: {self.blocked}\n"
+            f"Скорость: {self.throughput:.1f} сообщ./с"
+        )
+        kb = None if final else InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="⛔ Остановить", callback_data=f"bc:stop:{self.job_id}")
+        ]])
+        try:
+            if self.report_message_id:
+                try:
+                    await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.report_message_id,
+                                                     reply_markup=kb)
+                    return
+                except TelegramBadRequest as e:
+                    if "message is not modified" in str(e):
+                        return
+            msg = await self.bot.send_message(self.chat_id, text, reply_markup=kb)
+            self.report_message_id = msg.message_id
+        except Exception:
+            logger.exception("Cannot report broadcast #%s progress", self.job_id)
+
+async def run_broadcasts(bot: Bot):
+    while not DRAINING:
+        _broadcast_wake.clear()
+        try:
+            async with get_conn(PRIO_LOW) as conn:
+                jobs = await conn.fetch("SELECT * FROM broadcasts WHERE status='running' ORDER BY id")
+            for job in jobs:
+                if DRAINING:
+                    break
+                key = (BROADCAST_LOCK_NS, job["id"])
+                if not await lock_conn_call("fetchval", "SELECT pg_try_advisory_lock($1::int, $2::int)", *key):
+                    continue  # его ещё шлёт лидер прошлого деплоя
+                try:
+                    # перечитываем под блокировкой: прошлый отправитель мог сдвинуть курсор
+                    async with get_conn(PRIO_NORMAL) as conn:
+                        job = await conn.fetchrow("SELECT * FROM broadcasts WHERE id=$1", job["id"])
+                    if job["status"] == "running":
+                        run = BroadcastRun(bot, job)
+                        status = await run.run()
+                        logger.info("Broadcast #%s %s: %s sent, %s failed, %s blocked, %.1f msg/s",
+                                    run.job_id, status, run.sent, run.failed, run.blocked, run.throughput)
+                finally:
+                    try:
+                        await lock_conn_call("execute", "SELECT pg_advisory_unlock($1::int, $2::int)", *key)
+                    except Exception as e:  # соединение оборвалось — блокировка снята вместе с сессией
+                        logger.warning("Cannot unlock broadcast #%s: %r", job["id"], e)
+        except DbOverloaded:
+            pass
+        except Exception:
+            logger.exception("Broadcast runner failed")
+        for _ in range(30):
+            if DRAINING or _broadcast_wake.is_set():
+                break
+            await asyncio.sleep(1)
+
+@router.message(Command("broadcast"))
+async def broadcast_cmd(msg: Message, uow: UnitOfWork):
+    if not can_admin(msg.from_user.id, msg.chat.id, msg.chat.type):
+        return
+    body = re.sub(r"^/broadcast(@\w+)?\s*", "", msg.html_text or "")
+    if not body.strip():
+        return await msg.answer(
+            "Использование: /broadcast текст\n"
+            "Или по языкам, каждый с новой строки:\n/broadcast\nru: …\nlv: …\nen: …"
+        )
+    texts = parse_broadcast_texts(body)
+    conn = await uow.conn()
+    job_id = await conn.fetchval(
+        "INSERT INTO broadcasts(texts, created_by, chat_id) VALUES($1::jsonb, $2, $3) RETURNING id",
+        json.dumps(texts, ensure_ascii=False), msg.from_user.id, msg.chat.id
+    )
+    total = await conn.fetchval("SELECT COUNT(*) FROM users WHERE blocked_at IS NULL")
+    await uow.release()
+    preview = "\n\n".join(f"<b>{lang}</b>:\n{texts[lang]}" for lang in LANGS)
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="📣 Отправить", callback_data=f"bc:go:{job_id}"),
+        InlineKeyboardButton(text="Отмена", callback_data=f"bc:drop:{job_id}"),
+    ]])
+    await safe_send_text(msg.bot, msg.chat.id, f"Рассылка #{job_id}, получателей: {total}\n\n{preview}", reply_markup=kb)
+
+@router.callback_query(F.data.regexp(r"^bc:(go|drop|stop):\d+$"))
+async def broadcast_action(cb: CallbackQuery, uow: UnitOfWork):
+    if not can_admin(cb.from_user.id, cb.message.chat.id, cb.message.chat.type):
+        return await cb.answer()
+    _, action, job_id = cb.data.split(":")
+    conn = await uow.conn()
+    if action == "go":
+        ok = await conn.fetchval(
+            "UPDATE broadcasts SET status='running', started_at=now(), "
+            "total=(SELECT COUNT(*) FROM users WHERE blocked_at IS NULL) "
+            "WHERE id=$1 AND status='draft' RETURNING id",
+            int(job_id)
+        )
+        if ok:
+            await conn.execute("SELECT pg_notify('broadcast', $1)", job_id)
+    else:
+        ok = await conn.fetchval(
+            "UPDATE broadcasts SET status='cancelled', finished_at=now() "
+            "WHERE id=$1 AND status = ANY($2::text[]) RETURNING id",
+            int(job_id), ["draft"] if action == "drop" else ["draft", "running"]
+        )
+    await uow.release()
+    if action != "stop":
+        await cb.message.edit_reply_markup()
+    await cb.answer({"go": "Запущено", "drop": "Отменено", "stop": "Останавливаю"}[action] if ok else "Уже неактуально")
+
+# ===== Поиск броней (/find и inline-режим) =====
+SEARCH_LIMIT     = 20
+SEARCH_TIMEOUT_S = 2.0  # inline-ответ должен уложиться в несколько секунд
+SEARCH_TOO_SLOW  = "⏳ Поиск занял слишком долго — уточни запрос"
+
+SEARCH_COLUMNS = "id, user_id, name, phone, booking_date, booking_time, guests, table_id, status, created_at"
+
+def _prefix_range(prefix: str) -> tuple[str, str]:
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# Ветки по ID, суффиксу телефона и префиксу имени; каждая идёт по своему индексу
+# и сама ограничена LIMIT, поэтому время не зависит от размера таблицы
+async def search_bookings(conn: asyncpg.Connection, query: str, limit: int = SEARCH_LIMIT) -> list:
+    q = query.strip().lstrip("#")
+    digits = re.sub(r"\D", "", q)
+    branches, params = [], []
+    if q.isdigit() and len(q) <= 9:
+        params.append(int(q))
+        branches.append(f"SELECT {SEARCH_COLUMNS} FROM bookings WHERE id = ${len(params)}")
+    if len(digits) >= 3:
+        lo, hi = _prefix_range(digits[::-1])
+        params += [lo, hi]
+        expr = "reverse(regexp_replace(phone, '\\D', '', 'g'))"
+        branches.append(
+            f"(SELECT {SEARCH_COLUMNS} FROM bookings WHERE {expr} ~>=~ ${len(params) - 1} "
+            f"AND {expr} ~<~ ${len(params)} ORDER BY {expr} LIMIT {limit})"
+        )
+    name = q.lower()
+    if len(name) >= 2 and not digits:
+        lo, hi = _prefix_range(name)
+        params += [lo, hi]
+        branches.append(
+            f"(SELECT {SEARCH_COLUMNS} FROM bookings WHERE lower(name) ~>=~ ${len(params) - 1} "
+            f"AND lower(name) ~<~ ${len(params)} ORDER BY lower(name) LIMIT {limit})"
+        )
+    if not branches:
+        return []
+    rows = await conn.fetch(" UNION ALL ".join(branches), *params, timeout=SEARCH_TIMEOUT_S)
+    seen, result = set(), []
+    for r in rows:
+        if r["id"] not in seen:
+            seen.add(r["id"])
+            result.append(r)
+    return result[:limit]
+
+@router.message(Command("find"))
+async def find_cmd(msg: Message, uow: UnitOfWork):
+    if not can_admin(msg.from_user.id, msg.chat.id, msg.chat.type):
+        return
+    lang = await uow.lang("ru")
+    parts = (msg.text or "").split(maxsplit=1)
+    if len(parts) < 2:
+        return await msg.answer("Укажи телефон (последние цифры), имя или ID: /find 4567")
+    try:
+        rows = await uow.read(search_bookings, parts[1])
+    except asyncio.TimeoutError:
+        return await msg.answer(SEARCH_TOO_SLOW)
+    await uow.release()
+    text = "\n".join(fmt_admin_booking_line(r, lang) for r in rows) if rows else T(lang, "empty")
+    await safe_send_text(msg.bot, msg.chat.id, text)
+
+# Inline-режим (включается в @BotFather → /setinline): @bot 4567 в любом чате сотрудника
+@router.inline_query()
+async def find_inline(iq: InlineQuery, uow: UnitOfWork):
+    if not uow.is_staff or len(iq.query.strip()) < 2:
+        return await iq.answer([], cache_time=60, is_personal=True)
+    try:
+        rows = await uow.read(search_bookings, iq.query)
+    except asyncio.TimeoutError:
+        return await iq.answer([InlineQueryResultArticle(
+            id="slow", title=SEARCH_TOO_SLOW,
+            input_message_content=InputTextMessageContent(message_text=SEARCH_TOO_SLOW),
+        )], cache_time=5, is_personal=True)
+    lang = await uow.lang("ru")
+    await uow.release()
+    results = [
+        InlineQueryResultArticle(
+            id=str(r["id"]),
+            title=f"#{r['id']} {r['name']} — {r['booking_date']:%d.%m} {r['booking_time']:%H:%M}",
+            description=f"{r['phone']} · {T(lang, 'admin_field_guests').lower()}: {r['guests']} · {r['status']}",
+            input_message_content=InputTextMessageContent(message_text=fmt_admin_booking_line(r, lang)),
+        )
+        for r in rows
+    ]
+    await iq.answer(results, cache_time=5, is_personal=True)
+
+# БД перегружена или пул не отдал соединение — быстро отвечаем «попробуйте ещё раз»
+@router.errors(ExceptionTypeFilter(DbOverloaded, *CONN_LOST_ERRORS))
+async def on_db_overloaded(event: ErrorEvent):
+    upd = event.update
+    if upd.callback_query:
+        lang = pick_default_lang(upd.callback_query.from_user.language_code)
+        await upd.callback_query.answer(T(lang, "err_busy"), show_alert=True)
+    elif upd.message:
+        lang = pick_default_lang(upd.message.from_user.language_code if upd.message.from_user else None)
+        await upd.message.answer(T(lang, "err_busy"))
+    return True
+
 @router.message(Command("whoami"))
 async def whoami(msg: Message):
     await msg.reply(
@@ -1047,6 +3631,8 @@ async def whoami(msg: Message):
         f"name: {msg.from_user.full_name}"
     )
 
+startup_phase("import:module")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=PORT)
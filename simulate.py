@@ -0,0 +1,242 @@
+# simulate.py
+# Офлайн-симулятор вместимости: прогоняет историю броней (или синтетический спрос)
+# через альтернативные настройки — длительность брони, часы работы, набор столиков —
+# и считает отказы, загрузку столиков и число гостей.
+#
+# Правила те же, что в main.py (step_time + insert_bookings): время начала в
+# пределах OPEN_TIME..CLOSE_TIME, подходят активные столики с seats >= guests без
+# пересечений с броней 'new'/'confirmed' на эту дату, гость берёт первый из списка
+# (ORDER BY seats, title — самый маленький подходящий). Занятость столика за день
+# хранится битовой маской по минутам, так что проверка пересечения — одно `&`.
+#
+#   python simulate.py --db --duration 90,120 --close 22:00,23:00
+#   python simulate.py --synthetic 365 --tables 4,2,6 --tables 4,4,2,2,6 --jobs 4
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date as _date, datetime, time as _time
+
+# значения по умолчанию — как в main.py
+DEFAULT_OPEN     = "10:00"
+DEFAULT_CLOSE    = "22:00"
+DEFAULT_DURATION = 120
+DEFAULT_TABLES   = "4,2,6"
+
+@dataclass(frozen=True)
+class Config:
+    open_min: int
+    close_min: int
+    duration: int
+    tables: tuple[int, ...]
+
+    @property
+    def label(self) -> str:
+        return (f"{self.open_min // 60:02d}:{self.open_min % 60:02d}-{self.close_min // 60:02d}:{self.close_min % 60:02d} "
+                f"{self.duration}m [{','.join(map(str, self.tables))}]")
+
+# Запрос на бронь: (порядковый номер дня, минута начала, гостей); список уже в порядке поступления
+Request = tuple[int, int, int]
+
+def _minutes(value: str | _time) -> int:
+    if isinstance(value, str):
+        value = datetime.strptime(value.strip(), "%H:%M").time()
+    return value.hour * 60 + value.minute
+
+def simulate(requests: list[Request], cfg: Config) -> dict:
+    # порядок выдачи столиков как в ORDER BY t.seats, t.title
+    tables = sorted(range(len(cfg.tables)), key=lambda i: (cfg.tables[i], i))
+    base_mask = (1 << cfg.duration) - 1
+    occupancy: dict[int, list[int]] = {}
+    days: set[int] = set()
+    accepted = rejected = out_of_hours = covers = 0
+    for day, start, guests in requests:
+        days.add(day)
+        if not cfg.open_min <= start <= cfg.close_min:
+            out_of_hours += 1
+            continue
+        mask = base_mask << start
+        day_occ = occupancy.get(day)
+        if day_occ is None:
+            day_occ = occupancy[day] = [0] * len(cfg.tables)
+        for i in tables:
+            if cfg.tables[i] >= guests and not day_occ[i] & mask:
+                day_occ[i] |= mask
+                accepted += 1
+                covers += guests
+                break
+        else:
+            rejected += 1
+
+    # загрузка — доля занятых столико-минут в часы работы (хвосты после закрытия не считаем)
+    window = ((1 << max(cfg.close_min - cfg.open_min, 1)) - 1) << cfg.open_min
+    booked_minutes = sum((occ & window).bit_count() for day_occ in occupancy.values() for occ in day_occ)
+    open_minutes = max(cfg.close_min - cfg.open_min, 1) * len(cfg.tables) * max(len(days), 1)
+    total = len(requests)
+    return {
+        "config": cfg.label,
+        "requests": total,
+        "accepted": accepted,
+        "rejected": rejected,
+        "out_of_hours": out_of_hours,
+        "reject_rate": (rejected + out_of_hours) / total if total else 0.0,
+        "utilization": booked_minutes / open_minutes,
+        "covers": covers,
+        "covers_per_day": covers / max(len(days), 1),
+    }
+
+# ---------- источники спроса ----------
+def _arrival(r) -> datetime:
+    # created_at из БД — aware, из CSV — как записано; без него — время самой брони.
+    # Naive-значения считаем локальным временем, чтобы все ключи были aware и сравнимы
+    value = r[3] or datetime.combine(r[0], r[1])
+    return value if value.tzinfo else value.astimezone()
+
+def _to_requests(rows) -> list[Request]:
+    # rows: (booking_date, booking_time, guests, created_at | None)
+    rows = sorted(rows, key=lambda r: (_arrival(r), r[0], r[1]))
+    return [(r[0].toordinal(), _minutes(r[1]), int(r[2])) for r in rows]
+
+async def _load_db(url: str, statuses: list[str], since: _date | None, until: _date | None):
+    import asyncpg  # только для этого режима
+
+    conn = await asyncpg.connect(url)
+    try:
+        rows = await conn.fetch(
+            """
+            SELECT booking_date, booking_time, guests, created_at
+            FROM bookings
+            WHERE status = ANY($1::text[])
+              AND ($2::date IS NULL OR booking_date >= $2)
+              AND ($3::date IS NULL OR booking_date <= $3)
+            """,
+            statuses, since, until
+        )
+        seats = [r["seats"] for r in await conn.fetch(
+            "SELECT seats FROM tables WHERE is_active = TRUE ORDER BY seats, title"
+        )]
+    finally:
+        await conn.close()
+    return _to_requests([tuple(r) for r in rows]), seats
+
+def load_csv(path: str) -> list[Request]:
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = [
+            (_date.fromisoformat(r["booking_date"]),
+             datetime.strptime(r["booking_time"][:5], "%H:%M").time(),
+             int(r["guests"]),
+             datetime.fromisoformat(r["created_at"]) if r.get("created_at") else None)
+            for r in csv.DictReader(f)
+        ]
+    return _to_requests(rows)
+
+# Синтетика: пуассоновский поток по дням с недельной сезонностью, пики в обед и вечером
+def synthetic(days: int, per_day: float, seed: int) -> list[Request]:
+    rnd = random.Random(seed)
+    weekday_factor = (0.7, 0.7, 0.8, 0.9, 1.4, 1.6, 1.1)
+    party_sizes, party_weights = (1, 2, 3, 4, 5, 6, 8), (8, 45, 15, 18, 6, 5, 3)
+    start = _date.today().toordinal()
+    out: list[Request] = []
+    for d in range(days):
+        day = start + d
+        lam = per_day * weekday_factor[_date.fromordinal(day).weekday()]
+        # число заявок за день ~ Poisson(lam): через экспоненциальные интервалы
+        n, acc = 0, rnd.expovariate(1.0)
+        while acc < lam:
+            n += 1
+            acc += rnd.expovariate(1.0)
+        for _ in range(n):
+            peak = 13 * 60 if rnd.random() < 0.3 else 19 * 60
+            minute = int(rnd.gauss(peak, 75)) // 15 * 15
+            out.append((day, minute, rnd.choices(party_sizes, party_weights)[0]))
+    return out
+
+# ---------- CLI ----------
+def _csv_list(value: str) -> list[str]:
+    return [v for v in (p.strip() for p in value.split(",")) if v]
+
+def build_configs(args, default_tables: str) -> list[Config]:
+    tables = args.tables or [default_tables]
+    return [
+        Config(_minutes(o), _minutes(c), int(d), tuple(int(s) for s in _csv_list(t)))
+        for o, c, d, t in itertools.product(_csv_list(args.open), _csv_list(args.close),
+                                            _csv_list(args.duration), tables)
+    ]
+
+_REQUESTS: list[Request] = []
+
+def _init_worker(requests: list[Request]):
+    global _REQUESTS
+    _REQUESTS = requests
+
+def _run(cfg: Config) -> dict:
+    return simulate(_REQUESTS, cfg)
+
+def main(argv: list[str] | None = None) -> int:
+    p = argparse.ArgumentParser(description="Replay booking demand against alternative capacity configs.")
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument("--db", action="store_true", help="load bookings from DATABASE_URL")
+    src.add_argument("--csv", help="CSV with booking_date, booking_time, guests[, created_at]")
+    src.add_argument("--synthetic", type=int, metavar="DAYS", help="generate synthetic demand for DAYS days")
+    p.add_argument("--per-day", type=float, default=60, help="synthetic: mean requests per day")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--statuses", default="new,confirmed,cancelled", help="db: which booking statuses count as demand")
+    p.add_argument("--since", type=_date.fromisoformat)
+    p.add_argument("--until", type=_date.fromisoformat)
+    p.add_argument("--open", default=DEFAULT_OPEN, help="comma-separated HH:MM values")
+    p.add_argument("--close", default=DEFAULT_CLOSE, help="comma-separated HH:MM values")
+    p.add_argument("--duration", default=str(DEFAULT_DURATION), help="comma-separated minutes")
+    p.add_argument("--tables", action="append", help="comma-separated seat counts; repeat for several mixes")
+    p.add_argument("--jobs", type=int, default=1, help="worker processes")
+    p.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = p.parse_args(argv)
+
+    t0 = time.perf_counter()
+    default_tables = DEFAULT_TABLES
+    if args.db:
+        from dotenv import load_dotenv
+        load_dotenv()
+        url = os.getenv("DATABASE_URL", "")
+        if not url:
+            p.error("DATABASE_URL is not set")
+        requests, seats = asyncio.run(_load_db(url, _csv_list(args.statuses), args.since, args.until))
+        if seats:
+            default_tables = ",".join(map(str, seats))
+    elif args.csv:
+        requests = load_csv(args.csv)
+    else:
+        requests = synthetic(args.synthetic, args.per_day, args.seed)
+    configs = build_configs(args, default_tables)
+    t_load = time.perf_counter() - t0
+
+    if args.jobs > 1 and len(configs) > 1:
+        with ProcessPoolExecutor(args.jobs, initializer=_init_worker, initargs=(requests,)) as pool:
+            results = list(pool.map(_run, configs))
+    else:
+        results = [simulate(requests, cfg) for cfg in configs]
+    t_sim = time.perf_counter() - t0 - t_load
+
+    if args.json:
+        for r in results:
+            print(json.dumps(r, ensure_ascii=False))
+    else:
+        width = max(len(r["config"]) for r in results)
+        print(f"{'config'.ljust(width)}  {'requests':>8} {'accepted':>8} {'rejected':>8} {'hours':>6} "
+              f"{'rej%':>6} {'util%':>6} {'covers':>7} {'cov/day':>8}")
+        for r in results:
+            print(f"{r['config'].ljust(width)}  {r['requests']:>8} {r['accepted']:>8} {r['rejected']:>8} "
+                  f"{r['out_of_hours']:>6} {r['reject_rate'] * 100:>6.1f} {r['utilization'] * 100:>6.1f} "
+                  f"{r['covers']:>7} {r['covers_per_day']:>8.1f}")
+    print(f"{len(requests)} requests x {len(configs)} configs: load {t_load:.2f}s, simulate {t_sim:.2f}s",
+          file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())